@@ -0,0 +1,290 @@
+# coding: utf-8
+'''
+Benchmarks of router, middleware and database check hot paths.
+
+Runs against in-memory SQLite databases and a local-memory cache
+(requires Python 3.5+):
+
+    python benchmarks/bench.py
+    python benchmarks/bench.py --replicas 16 --overrides 500 -k router
+
+Reports time per operation and, on Python 3.9+, peak memory allocated
+during one operation. Results can be saved and used as a regression gate:
+
+    python benchmarks/bench.py --save baseline.json
+    python benchmarks/bench.py --compare baseline.json --tolerance 0.2
+
+The last command exits with status 1 if any benchmark is slower than
+in the baseline by more than the tolerance.
+'''
+from __future__ import unicode_literals
+
+import argparse
+import fnmatch
+import gc
+import json
+import os
+import sys
+import threading
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django.http import HttpResponse  # noqa: E402
+
+try:
+    from django.urls import re_path as url
+except ImportError:
+    from django.conf.urls import url
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def view(request):
+    return HttpResponse()
+
+
+urlpatterns = [
+    url(r'^$', view, name='index'),
+    url(r'^items/(?P<pk>\d+)/$', view, name='item'),
+]
+
+
+def configure(replicas, overrides):
+    from django_replicated import settings as replicated_settings
+
+    slaves = ['slave%d' % i for i in range(1, replicas + 1)]
+    databases = dict((alias, {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'})
+                     for alias in ['default'] + slaves)
+
+    # Half of overrides are path patterns, half are url names that never match.
+    views_overrides = {}
+    for i in range(overrides):
+        if i % 2:
+            views_overrides['/section%d/*' % i] = 'master'
+        else:
+            views_overrides['view-name-%d' % i] = 'master'
+
+    options = dict((name, value) for name, value in vars(replicated_settings).items() if name.isupper())
+    options.update({
+        'DATABASES': databases,
+        'DATABASE_ROUTERS': ['django_replicated.router.ReplicationRouter'],
+        'REPLICATED_DATABASE_SLAVES': slaves,
+        'REPLICATED_VIEWS_OVERRIDES': views_overrides,
+        'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        'ROOT_URLCONF': __name__,
+        'ALLOWED_HOSTS': ['*'],
+        'INSTALLED_APPS': [],
+    })
+    settings.configure(**options)
+    if hasattr(django, 'setup'):
+        django.setup()
+
+    return slaves
+
+
+def measure(func, number, repeat):
+    # The best of several runs is the least affected by other processes.
+    elapsed = None
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            started = default_timer()
+            for _ in range(number):
+                func()
+            run = default_timer() - started
+        finally:
+            gc.enable()
+        elapsed = run if elapsed is None else min(elapsed, run)
+
+    allocated = None
+    if tracemalloc is not None and hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.start()
+        try:
+            peaks = []
+            for _ in range(min(number, 100)):
+                current, _ = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+                func()
+                peaks.append(tracemalloc.get_traced_memory()[1] - current)
+            allocated = sum(peaks) // len(peaks)
+        finally:
+            tracemalloc.stop()
+
+    return elapsed / number * 1e9, allocated
+
+
+def benchmarks(slaves):
+    from django.test import RequestFactory
+    from django_replicated import dbchecker
+    from django_replicated.middleware import ReplicationMiddleware
+    from django_replicated.utils import routers
+
+    factory = RequestFactory()
+    middleware = ReplicationMiddleware(view)
+    get_request = factory.get('/items/1/')
+    post_request = factory.post('/items/1/')
+    response = HttpResponse()
+
+    def mark_dead(aliases):
+        for alias in slaves:
+            key = dbchecker.get_cache_key('is_alive', alias)
+            if alias in aliases:
+                dbchecker.cache.set(key, 'dead', 3600)
+            else:
+                dbchecker.cache.delete(key)
+
+    def router_read_cached():
+        routers.db_for_read()
+
+    def router_request():  # first read in a request
+        routers.init('slave')
+        routers.db_for_read()
+        routers.reset()
+
+    def middleware_get():
+        middleware.process_request(get_request)
+        middleware.process_response(get_request, response)
+
+    def middleware_post():
+        middleware.process_request(post_request)
+        middleware.process_response(post_request, response)
+
+    def state_override():
+        middleware.get_state_override(get_request)
+
+    def check_db_alive():
+        dbchecker.check_db(dbchecker.is_alive, slaves[0], 60)
+
+    def threaded(func, threads=8, per_thread=200):
+        def run():
+            for _ in range(per_thread):
+                func()
+
+        def concurrent():
+            workers = [threading.Thread(target=run) for _ in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        return concurrent, threads * per_thread
+
+    def asyncio_requests(tasks=50):
+        import asyncio
+
+        async def async_view(request):
+            return response
+
+        async_middleware = ReplicationMiddleware(async_view)
+
+        async def gather():
+            await asyncio.gather(*[async_middleware.__acall__(get_request) for _ in range(tasks)])
+
+        loop = asyncio.new_event_loop()
+
+        def concurrent():
+            loop.run_until_complete(gather())
+
+        return concurrent, tasks
+
+    def chosen():
+        mark_dead([])
+        routers.init('slave')
+        routers.db_for_read()
+
+    yield 'router.db_for_read[chosen]', router_read_cached, 1, chosen
+    yield 'router.request[all alive]', router_request, 1, lambda: mark_dead([])
+    yield 'router.request[half dead]', router_request, 1, lambda: mark_dead(slaves[:len(slaves) // 2])
+    yield 'router.request[all dead]', router_request, 1, lambda: mark_dead(slaves)
+    yield 'middleware.get_state_override', state_override, 1, None
+    yield 'middleware.request[GET]', middleware_get, 1, lambda: mark_dead([])
+    yield 'middleware.request[POST]', middleware_post, 1, None
+    yield 'dbchecker.check_db[alive]', check_db_alive, 1, lambda: mark_dead([])
+    yield 'dbchecker.check_db[dead mark]', check_db_alive, 1, lambda: mark_dead(slaves)
+
+    func, ops = threaded(router_request)
+    yield 'router.request[8 threads]', func, ops, lambda: mark_dead([])
+
+    try:
+        # Async middleware switches to threads through asgiref
+        import asgiref  # noqa: F401
+    except ImportError:
+        print('asgiref is not installed, skipping async benchmarks')
+    else:
+        func, ops = asyncio_requests()
+        yield 'middleware.request[50 tasks]', func, ops, lambda: mark_dead([])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--replicas', type=int, default=8)
+    parser.add_argument('--overrides', type=int, default=200)
+    parser.add_argument('--number', type=int, default=2000, help='operations per benchmark')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per benchmark, the best one is reported')
+    parser.add_argument('-k', dest='pattern', default='*', help='run benchmarks matching the glob')
+    parser.add_argument('--save', help='save results to a JSON file')
+    parser.add_argument('--compare', help='compare results with a JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown for --compare')
+    args = parser.parse_args()
+
+    slaves = configure(args.replicas, args.overrides)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    failed = []
+    print('%-36s %12s %12s %10s' % ('benchmark', 'ns/op', 'peak B/op', 'change'))
+    for name, func, ops, setup in benchmarks(slaves):
+        if not fnmatch.fnmatchcase(name, '*%s*' % args.pattern.strip('*')):
+            continue
+        number = max(1, args.number // ops)
+        try:
+            if setup is not None:
+                setup()
+            func()  # warm up
+            ns, allocated = measure(func, number, args.repeat)
+        except Exception as e:
+            failed.append(name)
+            print('%-36s failed: %r' % (name, e))
+            continue
+
+        ns /= ops
+        if allocated is not None:
+            allocated //= ops
+        results[name] = {'ns': ns, 'allocated': allocated}
+
+        change = ''
+        if name in baseline:
+            ratio = ns / baseline[name]['ns'] - 1
+            change = '%+.1f%%' % (ratio * 100)
+            if ratio > args.tolerance:
+                regressions.append(name)
+                change += ' !'
+
+        print('%-36s %12.0f %12s %10s' % (name, ns, '-' if allocated is None else allocated, change))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if failed:
+        print('\nFailed: %s' % ', '.join(failed))
+    if regressions:
+        print('\nSlower than baseline by more than %d%%: %s' % (args.tolerance * 100, ', '.join(regressions)))
+    if failed or regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
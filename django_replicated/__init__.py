@@ -0,0 +1,5 @@
+# coding: utf-8
+from .routing import use_master, use_slave, use_state  # noqa: F401
+
+# Django < 3.2 does not discover AppConfig subclasses automatically
+default_app_config = 'django_replicated.apps.ReplicatedConfig'
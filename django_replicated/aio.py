@@ -0,0 +1,93 @@
+# coding: utf-8
+'''
+Asyncio support (python 3 only).
+
+Routing state is stored in ``contextvars``, so concurrent coroutines
+handling different requests do not share it. ``AsyncMiddlewareMixin``
+lets ``ReplicationMiddleware`` run in an async middleware chain under
+ASGI: its hooks run in the event loop, and switch to the thread of
+synchronous code only when they may block (e.g. reading the master
+replication position or loading the session for 'user' affinity).
+
+Async variants of database checks run the checks in a thread, since
+Django database connections are synchronous. Prefer background probing
+(``REPLICATED_PROBE_INTERVAL``) to keep checks off the request path
+altogether.
+'''
+from __future__ import unicode_literals
+
+import functools
+
+from . import dbchecker
+from .utils import routers
+
+
+class AsyncMiddlewareMixin(object):
+    '''
+    Requires ``request_blocks`` and ``response_blocks`` telling whether
+    ``process_request`` and ``process_response`` may do blocking I/O.
+    '''
+    async_capable = True
+
+    async def __acall__(self, request):
+        if self.request_blocks(request):
+            response = await in_sync_thread(self.process_request, request)
+        else:
+            response = self.process_request(request)
+
+        if response is None:
+            response = await self.get_response(request)
+
+        if self.response_blocks(request, response):
+            return await in_sync_thread(self.process_response, request, response)
+        return self.process_response(request, response)
+
+
+async def in_sync_thread(func, *args):
+    '''
+    Calls a function of synchronous code the way Django's ``MiddlewareMixin``
+    does, keeping the routing context it leaves.
+    '''
+    from asgiref.sync import sync_to_async
+
+    def call():
+        # Older asgiref does not copy context variables back from the thread
+        return func(*args), routers.router.context
+
+    result, context = await sync_to_async(call, thread_sensitive=True)()
+    routers.router.set_context(context)
+    return result
+
+
+async def check_db(checker, db_name, cache_seconds=None, number_of_tries=1, force=False):
+    from asgiref.sync import sync_to_async
+
+    return await sync_to_async(dbchecker.check_db)(
+        checker, db_name, cache_seconds=cache_seconds, number_of_tries=number_of_tries, force=force,
+    )
+
+
+async def db_is_alive(db_name, cache_seconds=None, number_of_tries=1, force=False):
+    return await check_db(dbchecker.is_alive, db_name, cache_seconds, number_of_tries, force)
+
+
+async def db_is_writable(db_name, cache_seconds=None, number_of_tries=1, force=False):
+    return await check_db(dbchecker.is_writable, db_name, cache_seconds, number_of_tries, force)
+
+
+async def db_replication_lag(db_name, cache_seconds=None, force=False):
+    from asgiref.sync import sync_to_async
+
+    return await sync_to_async(dbchecker.check_replication_lag)(db_name, cache_seconds=cache_seconds, force=force)
+
+
+def wrap_coroutine(state, func):
+    '''
+    Wraps a coroutine function to run in ``state`` (a ``routing.use_state``).
+    '''
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with state:
+            return await func(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,16 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class ReplicatedConfig(AppConfig):
+    name = 'django_replicated'
+    verbose_name = 'Replicated'
+
+    def ready(self):
+        if settings.REPLICATED_WARMUP:
+            from .warmup import warmup
+
+            warmup()
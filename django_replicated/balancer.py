@@ -0,0 +1,212 @@
+# coding: utf-8
+'''
+Replica selection strategies.
+
+Every strategy takes a list of candidate aliases and returns them in the
+order in which the router should try them. The first alive alias wins,
+so the rest of the list only matters when better candidates are dead.
+
+Strategies use per-alias statistics collected in the process-wide
+``stats`` registry. It is fed by ``dbchecker.check_db`` probes and,
+optionally, by timing every query executed on replicas
+(see ``install_query_timing``).
+'''
+from __future__ import unicode_literals
+
+import hashlib
+import math
+import random
+import threading
+from timeit import default_timer
+
+import six
+
+
+# Smoothing factor for latency and error rate averages: the weight of
+# the newest sample.
+EWMA_ALPHA = 0.3
+
+# How much a 100% error rate inflates an alias score.
+ERROR_PENALTY = 10
+
+
+class ReplicaStats(object):
+    '''
+    Exponentially weighted moving averages of latency (in seconds) and
+    error rate for every database alias.
+    '''
+    def __init__(self, alpha=EWMA_ALPHA):
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._errors = {}
+
+    def record(self, alias, latency=None, error=False):
+        alpha = self.alpha
+        with self._lock:
+            if latency is not None:
+                previous = self._latency.get(alias)
+                if previous is None:
+                    self._latency[alias] = latency
+                else:
+                    self._latency[alias] = previous + alpha * (latency - previous)
+
+            previous = self._errors.get(alias, 0.0)
+            self._errors[alias] = previous + alpha * (float(error) - previous)
+
+    def latency(self, alias):
+        return self._latency.get(alias, 0.0)
+
+    def error_rate(self, alias):
+        return self._errors.get(alias, 0.0)
+
+    def score(self, alias, weight=1):
+        '''
+        Lower is better. Aliases without samples score 0 so that they
+        get probed as soon as possible.
+        '''
+        penalty = 1 + ERROR_PENALTY * self.error_rate(alias)
+        return self.latency(alias) * penalty / weight
+
+    def reset(self):
+        with self._lock:
+            self._latency.clear()
+            self._errors.clear()
+
+
+stats = ReplicaStats()
+
+
+class RandomBalancer(object):
+    '''
+    Random order, optionally biased by static per-alias weights.
+    Without weights this is a plain shuffle.
+    '''
+    def __init__(self, weights=None, stats=stats):
+        self.weights = dict(weights or {})
+        self.stats = stats
+
+    def weight(self, alias):
+        return self.weights.get(alias, 1)
+
+    def order(self, aliases):
+        if not self.weights:
+            aliases = list(aliases)
+            random.shuffle(aliases)
+            return aliases
+
+        # Weighted random permutation (Efraimidis-Spirakis): sorting by
+        # u ** (1 / w) puts heavier aliases first proportionally to w.
+        keyed = []
+        for alias in aliases:
+            weight = self.weight(alias)
+            if weight <= 0:
+                continue
+            keyed.append((random.random() ** (1.0 / weight), alias))
+        keyed.sort(reverse=True)
+        return [alias for _, alias in keyed]
+
+
+class LeastLatencyBalancer(RandomBalancer):
+    '''
+    Orders aliases by their weighted latency score. Ties, including
+    aliases without samples yet, are broken randomly.
+    '''
+    def order(self, aliases):
+        aliases = super(LeastLatencyBalancer, self).order(aliases)
+        return sorted(aliases, key=lambda alias: self.stats.score(alias, self.weight(alias)))
+
+
+class PowerOfTwoBalancer(RandomBalancer):
+    '''
+    Power of two choices: takes two random (weighted) aliases and puts the
+    one with the better score first. Spreads load almost as well as random
+    choice while steering away from slow replicas, and avoids the herding
+    of always picking the single fastest one.
+    '''
+    def order(self, aliases):
+        aliases = super(PowerOfTwoBalancer, self).order(aliases)
+        if len(aliases) >= 2:
+            first, second = aliases[0], aliases[1]
+            if self.stats.score(second, self.weight(second)) < self.stats.score(first, self.weight(first)):
+                aliases[0], aliases[1] = second, first
+        return aliases
+
+
+def rendezvous_order(key, aliases, weights=None):
+    '''
+    Orders aliases by weighted rendezvous hashing of the key: the same key
+    always gets the same order, and removing an alias only moves keys that
+    had it first to their second choice.
+    '''
+    weights = weights or {}
+    scored = []
+    for alias in aliases:
+        weight = weights.get(alias, 1)
+        if weight <= 0:
+            continue
+        digest = hashlib.md5(('%s:%s' % (key, alias)).encode('utf-8')).hexdigest()
+        # Uniform in (0, 1)
+        point = (int(digest[:13], 16) + 1) / float(2 ** 52 + 1)
+        scored.append((-weight / math.log(point), alias))
+    scored.sort(reverse=True)
+    return [alias for _, alias in scored]
+
+
+BALANCERS = {
+    'random': RandomBalancer,
+    'least_latency': LeastLatencyBalancer,
+    'p2c': PowerOfTwoBalancer,
+}
+
+
+def get_balancer(name, weights=None):
+    '''
+    Returns balancer instance by a short name from ``BALANCERS``
+    or by an import path of a class with the same interface.
+    '''
+    if isinstance(name, six.string_types):
+        if name in BALANCERS:
+            cls = BALANCERS[name]
+        else:
+            from django.utils.module_loading import import_string
+            cls = import_string(name)
+    else:
+        cls = name
+
+    return cls(weights=weights)
+
+
+def time_query(alias):
+    '''
+    Returns an execute wrapper (Django 2.0+) recording query latency
+    for the alias into ``stats``.
+    '''
+    def wrapper(execute, sql, params, many, context):
+        started = default_timer()
+        try:
+            result = execute(sql, params, many, context)
+        except Exception:
+            stats.record(alias, error=True)
+            raise
+        stats.record(alias, default_timer() - started)
+        return result
+
+    return wrapper
+
+
+def install_query_timing(aliases):
+    '''
+    Times every query on new connections to given aliases. Requires
+    ``connection.execute_wrappers`` (Django 2.0+), otherwise does nothing.
+    '''
+    from django.db.backends.signals import connection_created
+
+    aliases = frozenset(aliases)
+
+    def on_connection_created(sender, connection, **kwargs):
+        if connection.alias in aliases and hasattr(connection, 'execute_wrappers'):
+            connection.execute_wrappers.append(time_query(connection.alias))
+
+    connection_created.connect(on_connection_created, weak=False,
+                               dispatch_uid='django_replicated.balancer.query_timing')
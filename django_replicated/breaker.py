@@ -0,0 +1,89 @@
+# coding: utf-8
+'''
+Circuit breaker for database checks.
+
+A breaker is closed while checks succeed. After ``threshold`` consecutive
+failed checks (counted across requests and processes through the cache) it
+opens and the database is considered dead without checking. When the open
+period ends the breaker becomes half-open: exactly one caller, holding
+a lock in the cache, is allowed to check the database, all others still
+consider it dead. Success closes the breaker, failure opens it again for
+a twice longer period, up to ``max_timeout``.
+'''
+from __future__ import unicode_literals
+
+import logging
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+EMPTY = (0, 0, None)
+
+
+class CircuitBreaker(object):
+    def __init__(self, cache, key, timeout, threshold=1, max_timeout=None, clock=time.time):
+        self.cache = cache
+        self.key = key
+        self.lock_key = key + ':probe'
+        self.timeout = timeout
+        self.threshold = threshold
+        self.max_timeout = max(max_timeout or timeout, timeout)
+        self.clock = clock
+        self._loaded = None
+
+    def _load(self):
+        # (failures in a row, number of openings in a row, time to retry)
+        self._loaded = self.cache.get(self.key) or EMPTY
+        return self._loaded
+
+    def _save(self, failures, openings, retry_at):
+        # Kept long enough to remember openings for the backoff.
+        self.cache.set(self.key, (failures, openings, retry_at), self.max_timeout * 2)
+
+    def state(self):
+        failures, openings, retry_at = self._load()
+        if retry_at is None:
+            return CLOSED
+        if self.clock() < retry_at:
+            return OPEN
+        return HALF_OPEN
+
+    def allow(self):
+        '''
+        Whether the caller should check the database. In half-open state
+        only the caller that acquired the probe lock is allowed.
+        '''
+        state = self.state()
+        if state == CLOSED:
+            return True
+        if state == OPEN:
+            return False
+        return bool(self.cache.add(self.lock_key, True, self.timeout))
+
+    def success(self):
+        loaded = self._loaded if self._loaded is not None else self._load()
+        if loaded == EMPTY:
+            return
+
+        log.debug('Closing circuit breaker %s', self.key)
+        self.cache.delete(self.key)
+        self.cache.delete(self.lock_key)
+
+    def failure(self):
+        failures, openings, retry_at = self._loaded if self._loaded is not None else self._load()
+        failures += 1
+
+        if retry_at is None and failures < self.threshold:
+            self._save(failures, openings, None)
+            return
+
+        timeout = min(self.timeout * 2 ** openings, self.max_timeout)
+        log.debug('Opening circuit breaker %s for %s seconds', self.key, timeout)
+        self._save(failures, openings + 1, self.clock() + timeout)
+        self.cache.delete(self.lock_key)
@@ -3,7 +3,9 @@ from __future__ import unicode_literals
 
 import logging
 import socket
+import threading
 from functools import partial
+from timeit import default_timer
 
 import django
 from django.conf import settings
@@ -18,15 +20,26 @@ else:
     def get_cache(alias): return caches[alias]
 
 
-from .utils import get_object_name
+from .balancer import stats
+from .breaker import CircuitBreaker
+from .metrics import metrics
+from .localcache import TieredCache
+from .utils import futures, get_executor, get_object_name
 
 
 log = logging.getLogger(__name__)
 
-cache = get_cache(settings.REPLICATED_CACHE_BACKEND or DEFAULT_CACHE_ALIAS)
+cache = TieredCache(
+    get_cache(settings.REPLICATED_CACHE_BACKEND or DEFAULT_CACHE_ALIAS),
+    local_seconds=settings.REPLICATED_LOCAL_CACHE_SECONDS,
+    max_size=settings.REPLICATED_LOCAL_CACHE_SIZE,
+)
 
 hostname = socket.getfqdn()
 
+# Cached result of a failed check
+DEAD_MARK = 'dead'
+
 
 def is_alive(connection):
     if connection.connection is not None and hasattr(connection.connection, 'ping'):
@@ -39,9 +52,11 @@ def is_alive(connection):
         except TypeError:
             connection.connection.ping()
     else:
-        log.debug('Get cursor for db: %s', connection.alias)
-        with connection.cursor():
-            pass
+        log.debug('Select from db: %s', connection.alias)
+        # Opening a cursor on an open connection does not reach the server
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1' + getattr(connection.features, 'bare_select_suffix', ''))
+            cursor.fetchone()
 
     return True
 
@@ -64,32 +79,253 @@ def is_writable(connection):
     return result
 
 
-def check_db(checker, db_name, cache_seconds=None, number_of_tries=1, force=False):
-    assert number_of_tries >= 1, 'Number of tries must be >= 1.'
+def parse_interval(value):
+    '''
+    Parses Oracle "INTERVAL DAY TO SECOND" string like "+00 00:00:05.000"
+    into seconds.
+    '''
+    days, _, time_part = value.strip().lstrip('+').partition(' ')
+    hours, minutes, seconds = time_part.split(':')
+    return int(days) * 86400 + int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def replication_lag(connection):
+    '''
+    Returns replication lag of the database in seconds: 0 for a master,
+    ``float('inf')`` for a replica with stopped replication and None if lag
+    can not be determined for the database vendor.
+    '''
+    result = None
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            cursor.execute('SHOW SLAVE STATUS')
+            row = cursor.fetchone()
+            if row is None:
+                result = 0
+            else:
+                columns = [column[0] for column in cursor.description]
+                lag = dict(zip(columns, row))['Seconds_Behind_Master']
+                result = float('inf') if lag is None else float(lag)
+
+        elif connection.vendor in ('postgresql', 'postgresql_psycopg2', 'postgis'):
+            # Replay timestamp of an idle master stops moving, so replicas
+            # streaming from the master and having replayed everything they
+            # received are considered up to date. A replica without a WAL
+            # receiver has replayed everything too, but its lag grows.
+            pg_version = getattr(connection, 'pg_version', 0)
+            if pg_version >= 100000:
+                caught_up = 'pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()'
+            else:
+                caught_up = 'pg_last_xlog_receive_location() = pg_last_xlog_replay_location()'
+            if pg_version >= 90600:
+                # Details of the receiver are hidden from unprivileged users
+                streaming = (
+                    "EXISTS (SELECT 1 FROM pg_stat_wal_receiver"
+                    " WHERE pid IS NOT NULL AND coalesce(status, 'streaming') = 'streaming')"
+                )
+            else:
+                streaming = 'false'
+            cursor.execute(
+                'SELECT CASE'
+                ' WHEN NOT pg_is_in_recovery() THEN 0'
+                ' WHEN %s AND %s THEN 0'
+                ' ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())'
+                ' END' % (streaming, caught_up)
+            )
+            lag = cursor.fetchone()[0]
+            result = float('inf') if lag is None else float(lag)
+
+        elif connection.vendor == 'oracle':
+            cursor.execute("SELECT database_role FROM v$database")
+            if cursor.fetchone()[0] == 'PRIMARY':
+                result = 0
+            else:
+                cursor.execute("SELECT value FROM v$dataguard_stats WHERE name = 'apply lag'")
+                row = cursor.fetchone()
+                result = float('inf') if row is None or row[0] is None else parse_interval(row[0])
+
+    return result
 
+
+def replication_position(connection):
+    '''
+    Returns current replication position of the master: executed GTID set
+    for MySQL and WAL LSN for PostgreSQL. None for other vendors.
+    '''
+    result = None
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            cursor.execute('SELECT @@GLOBAL.gtid_executed')
+            result = ''.join(cursor.fetchone()[0].split()) or None
+
+        elif connection.vendor in ('postgresql', 'postgresql_psycopg2', 'postgis'):
+            if getattr(connection, 'pg_version', 0) >= 100000:
+                cursor.execute('SELECT pg_current_wal_lsn()')
+            else:
+                cursor.execute('SELECT pg_current_xlog_location()')
+            result = cursor.fetchone()[0]
+
+    return result
+
+
+def has_replayed(connection, position):
+    '''
+    Whether the database has replayed changes up to the replication
+    position returned by ``replication_position`` on the master.
+    '''
+    result = False
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            cursor.execute('SELECT GTID_SUBSET(%s, @@GLOBAL.gtid_executed)', [position])
+            result = bool(cursor.fetchone()[0])
+
+        elif connection.vendor in ('postgresql', 'postgresql_psycopg2', 'postgis'):
+            if getattr(connection, 'pg_version', 0) >= 100000:
+                replayed = 'pg_last_wal_replay_lsn()'
+            else:
+                replayed = 'pg_last_xlog_replay_location()'
+            cursor.execute(
+                'SELECT CASE WHEN pg_is_in_recovery() THEN %s >= %%s::pg_lsn ELSE true END' % replayed,
+                [position]
+            )
+            result = bool(cursor.fetchone()[0])
+
+    return result
+
+
+def get_replication_position(db_name):
+    '''
+    Returns replication position of the database or None on errors.
+    '''
+    try:
+        return replication_position(connections[db_name])
+    except Exception:
+        log.exception('Error getting replication position: %s', db_name)
+
+
+def check_replayed(db_name, position):
+    '''
+    Returns whether the database has replayed the position, errors
+    are logged and considered as not replayed.
+    '''
+    try:
+        result = has_replayed(connections[db_name], position)
+    except Exception:
+        log.exception('Error checking replication position of %s: %s', db_name, position)
+        result = False
+
+    log.debug('Position %s replayed by %s: %s', position, db_name, result)
+    return result
+
+
+def check_replication_lag(db_name, cache_seconds=None, force=False):
+    '''
+    Returns replication lag of the database (see ``replication_lag``)
+    caching it for ``cache_seconds``. Errors are logged and reported
+    as unknown lag, dead databases are detected by ``is_alive``.
+    '''
     connection = connections[db_name]
 
-    checker_name = get_object_name(checker)
-    cache_key = ':'.join((hostname, checker_name, db_name))
-    dead_mark = 'dead'
+    cache_key = ':'.join((hostname, 'replication_lag', db_name))
+    unknown_mark = 'unknown'
 
     if not force and cache_seconds is not None:
-        is_dead = cache.get(cache_key) == dead_mark
+        lag = cache.get(cache_key)
+        if lag is not None:
+            log.debug('Replication lag of %s from cache: %s', db_name, lag)
+            return None if lag == unknown_mark else lag
 
-        if is_dead:
-            log.debug(
-                'Check "%s" %s was failed less than %d ago, no check needed',
-                checker_name, db_name, cache_seconds
-            )
+    try:
+        lag = replication_lag(connection)
+    except Exception:
+        log.exception('Error checking replication lag: %s', db_name)
+        lag = None
 
-            return False
+    log.debug('Replication lag of %s: %s', db_name, lag)
+
+    if cache_seconds is not None:
+        cache.set(cache_key, unknown_mark if lag is None else lag, cache_seconds)
+
+    return lag
+
+
+def get_cache_key(checker_name, db_name):
+    return ':'.join((hostname, checker_name, db_name))
+
+
+class HealthBatch(object):
+    '''
+    Checks several databases with one checker like ``check_db``, but gets
+    dead marks of all of them with one ``cache.get_many`` and saves new
+    dead marks with one ``cache.set_many`` on ``flush``.
+
+    With ``REPLICATED_CHECK_TIMEOUT`` checks of several databases can run
+    in parallel: ``start`` them first, then ``check`` waits for results.
+
+    With circuit breakers enabled databases are checked by ``check_db``.
+    '''
+    def __init__(self, checker, db_names, cache_seconds=None, number_of_tries=1):
+        self.checker = checker
+        self.checker_name = get_object_name(checker)
+        self.cache_seconds = cache_seconds
+        self.number_of_tries = number_of_tries
+        self.breaker = settings.REPLICATED_CIRCUIT_BREAKER
+        self.dead = {}
+        self.running = {}
+
+        self.keys = dict((db_name, get_cache_key(self.checker_name, db_name)) for db_name in db_names)
+        if cache_seconds is None or self.breaker:
+            self.marks = {}
         else:
-            log.debug(
-                'Last check "%s" %s succeeded or was more than %d ago, checking again',
-                db_name, checker_name, cache_seconds
-            )
-    else:
-        log.debug('Force check %s: %s', checker_name, db_name)
+            self.marks = cache.get_many(list(self.keys.values()))
+
+    def is_dead(self, db_name):
+        return self.marks.get(self.keys[db_name]) == DEAD_MARK
+
+    def start(self, db_names):
+        '''
+        Starts checks of databases without dead marks in the background
+        if checks have a deadline, otherwise does nothing.
+        '''
+        if settings.REPLICATED_CHECK_TIMEOUT is None or self.breaker:
+            return
+
+        for db_name in db_names:
+            if db_name in self.keys and db_name not in self.running and not self.is_dead(db_name):
+                self.running[db_name] = start_check(self.checker, db_name, self.number_of_tries)
+
+    def check(self, db_name):
+        if self.breaker or db_name not in self.keys:
+            return check_db(self.checker, db_name, self.cache_seconds, self.number_of_tries)
+
+        if self.cache_seconds is not None:
+            is_dead = self.is_dead(db_name)
+            if metrics.enabled:
+                metrics.incr('dead_mark_hits' if is_dead else 'dead_mark_misses',
+                             alias=db_name, check=self.checker_name)
+            if is_dead:
+                return False
+
+        if db_name in self.running:
+            result = wait_check(self.running[db_name], settings.REPLICATED_CHECK_TIMEOUT, db_name)
+        else:
+            result = run_check(self.checker, db_name, self.number_of_tries)
+        if not result and self.cache_seconds is not None:
+            self.dead[self.keys[db_name]] = DEAD_MARK
+        return result
+
+    def flush(self):
+        if self.dead:
+            cache.set_many(self.dead, self.cache_seconds)
+            self.dead = {}
+
+
+def run_checker(checker, db_name, number_of_tries=1):
+    '''
+    Runs the checker up to ``number_of_tries`` times until it succeeds.
+    '''
+    connection = connections[db_name]
+    checker_name = get_object_name(checker)
 
     for count in range(1, number_of_tries + 1):
         log.debug(
@@ -97,13 +333,20 @@ def check_db(checker, db_name, cache_seconds=None, number_of_tries=1, force=Fals
             db_name, checker_name, count
         )
 
+        started = default_timer()
         try:
             result = checker(connection)
         except Exception:
             if count == number_of_tries:
                 log.exception('Error verifying %s: %s', checker_name, db_name)
 
+            stats.record(db_name, error=True)
             result = False
+        else:
+            stats.record(db_name, default_timer() - started)
+
+        if metrics.enabled:
+            metrics.observe('probe_seconds', default_timer() - started, alias=db_name, check=checker_name)
 
         log.debug(
             'After %d tries "%s" %s = %s',
@@ -113,11 +356,164 @@ def check_db(checker, db_name, cache_seconds=None, number_of_tries=1, force=Fals
         if result:
             break
 
+    return result
+
+
+def run_pooled_checker(checker, db_name, number_of_tries=1):
+    '''
+    ``run_checker`` for a pool thread, which has no request cycle closing
+    broken or expired (``CONN_MAX_AGE``) connections.
+    '''
+    try:
+        return run_checker(checker, db_name, number_of_tries)
+    finally:
+        connections[db_name].close_if_unusable_or_obsolete()
+
+
+# Checks running in the pool: (checker name, alias) -> (start time, future)
+_checks = {}
+_checks_lock = threading.Lock()
+
+
+def start_check(checker, db_name, number_of_tries=1):
+    '''
+    Starts ``run_checker`` in the shared pool of ``REPLICATED_CHECK_WORKERS``
+    threads unless the same check of the database is still running (e.g. it
+    hangs). Returns a tuple of the start time and a future.
+    '''
+    key = (get_object_name(checker), db_name)
+    with _checks_lock:
+        running = _checks.get(key)
+        if running is None or running[1].done():
+            executor = get_executor('Database checks', settings.REPLICATED_CHECK_WORKERS)
+            future = executor.submit(run_pooled_checker, checker, db_name, number_of_tries)
+            running = _checks[key] = default_timer(), future
+    return running
+
+
+def wait_check(running, timeout, db_name):
+    '''
+    Waits for a check started by ``start_check`` until ``timeout`` seconds
+    after its start. A check that does not finish in time fails.
+    '''
+    started, future = running
+    try:
+        return future.result(max(0, started + timeout - default_timer()))
+    except futures.TimeoutError:
+        log.warning('Check of %s has not finished in %s seconds', db_name, timeout)
+        if metrics.enabled:
+            metrics.incr('check_timeouts', alias=db_name)
+        return False
+
+
+def run_check(checker, db_name, number_of_tries=1):
+    '''
+    Runs the checker in the current thread or, with ``REPLICATED_CHECK_TIMEOUT``,
+    in the shared pool with that deadline for all tries.
+    '''
+    timeout = settings.REPLICATED_CHECK_TIMEOUT
+    if timeout is None:
+        return run_checker(checker, db_name, number_of_tries)
+    return wait_check(start_check(checker, db_name, number_of_tries), timeout, db_name)
+
+
+def check_with_breaker(checker, db_name, cache_seconds, number_of_tries=1):
+    '''
+    Checks the database through a circuit breaker (see ``breaker``)
+    opening for ``cache_seconds`` and then for exponentially longer
+    periods up to ``REPLICATED_CIRCUIT_BREAKER_MAX_DOWNTIME``.
+    '''
+    checker_name = get_object_name(checker)
+    breaker = CircuitBreaker(
+        cache, get_cache_key(checker_name, db_name) + ':breaker', cache_seconds,
+        threshold=settings.REPLICATED_CIRCUIT_BREAKER_THRESHOLD,
+        max_timeout=settings.REPLICATED_CIRCUIT_BREAKER_MAX_DOWNTIME,
+    )
+
+    allowed = breaker.allow()
+
+    if metrics.enabled:
+        metrics.incr('dead_mark_misses' if allowed else 'dead_mark_hits', alias=db_name, check=checker_name)
+
+    if not allowed:
+        log.debug('Circuit breaker for "%s" %s is open, no check needed', checker_name, db_name)
+        return False
+
+    result = run_check(checker, db_name, number_of_tries)
+    if result:
+        breaker.success()
+    else:
+        breaker.failure()
+
+    return result
+
+
+def check_db(checker, db_name, cache_seconds=None, number_of_tries=1, force=False):
+    assert number_of_tries >= 1, 'Number of tries must be >= 1.'
+
+    checker_name = get_object_name(checker)
+    cache_key = get_cache_key(checker_name, db_name)
+
+    if not force and cache_seconds is not None:
+        if settings.REPLICATED_CIRCUIT_BREAKER:
+            return check_with_breaker(checker, db_name, cache_seconds, number_of_tries)
+
+        is_dead = cache.get(cache_key) == DEAD_MARK
+
+        if metrics.enabled:
+            metrics.incr('dead_mark_hits' if is_dead else 'dead_mark_misses', alias=db_name, check=checker_name)
+
+        if is_dead:
+            log.debug(
+                'Check "%s" %s was failed less than %d ago, no check needed',
+                checker_name, db_name, cache_seconds
+            )
+
+            return False
+        else:
+            log.debug(
+                'Last check "%s" %s succeeded or was more than %d ago, checking again',
+                db_name, checker_name, cache_seconds
+            )
+    else:
+        log.debug('Force check %s: %s', checker_name, db_name)
+
+    result = run_check(checker, db_name, number_of_tries)
+
     if not result and cache_seconds is not None:
-        cache.set(cache_key, dead_mark, cache_seconds)
+        cache.set(cache_key, DEAD_MARK, cache_seconds)
 
     return result
 
 
+def check_master(name, db_names, cache_seconds, downtime=None):
+    '''
+    Returns the first alive and writable database of ``db_names``, caching
+    the choice for ``cache_seconds`` under the name (e.g. of a cluster).
+    If none is writable, returns the first one.
+    '''
+    cache_key = get_cache_key('master', name)
+    master = cache.get(cache_key)
+    if master in db_names:
+        return master
+
+    master = db_names[0]
+    for db_name in db_names:
+        if check_db(is_alive, db_name, downtime) and check_db(is_writable, db_name):
+            master = db_name
+            break
+    else:
+        log.error('No writable database among %s', ', '.join(db_names))
+
+    if master != db_names[0]:
+        log.warning('Database %s is writable instead of %s', master, db_names[0])
+        if metrics.enabled:
+            metrics.incr('master_failovers', cluster=name, alias=master)
+
+    cache.set(cache_key, master, cache_seconds)
+    return master
+
+
 db_is_alive = partial(check_db, is_alive)
 db_is_writable = partial(check_db, is_writable)
+db_replication_lag = check_replication_lag
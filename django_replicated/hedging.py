@@ -0,0 +1,133 @@
+# coding: utf-8
+'''
+Hedged reads.
+
+A hedged read is sent to the best suitable slave and, if it has not
+answered within a delay, to the second best one as well. The first result
+wins. The delay is a percentile (``REPLICATED_HEDGE_PERCENTILE``) of recent
+hedged read durations, so only the slowest reads are duplicated.
+
+Reads run in a shared thread pool with their own database connections.
+A losing read can only be cancelled if it has not started yet, otherwise
+it finishes in the background and its result is discarded, so hedging is
+meant for a few latency-critical read-only queries:
+
+    from django_replicated.hedging import hedged_queryset
+
+    items = hedged_queryset(Item.objects.filter(featured=True))
+'''
+from __future__ import unicode_literals
+
+import logging
+import threading
+from collections import deque
+from timeit import default_timer
+
+from django.conf import settings
+from django.db import connections
+
+from .metrics import metrics
+from .utils import futures, get_executor, routers
+
+
+log = logging.getLogger(__name__)
+
+
+# Percentile delay is used after this number of samples.
+MIN_SAMPLES = 20
+
+
+class LatencyWindow(object):
+    '''
+    Durations of the last ``size`` reads in seconds.
+    '''
+    def __init__(self, size=1000):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, percent, default=None):
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < MIN_SAMPLES:
+            return default
+        index = min(len(samples) - 1, int(len(samples) * percent / 100.0))
+        return samples[index]
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+
+
+latencies = LatencyWindow()
+
+
+def hedge_delay():
+    return latencies.percentile(settings.REPLICATED_HEDGE_PERCENTILE, settings.REPLICATED_HEDGE_DELAY)
+
+
+def hedged_read(read, model=None, delay=None):
+    '''
+    Calls ``read(alias)`` for the best slave suitable for reads of the model
+    and, if it takes longer than ``delay`` seconds (by default the percentile
+    of recent reads), for the second best one. Returns the first result.
+
+    Queries made by ``read`` without explicit ``.using(alias)`` are routed
+    to the alias too. In master state, or with less than two suitable
+    slaves, ``read`` is called in the current thread without hedging.
+    '''
+    router = routers.router
+    candidates = router.read_candidates(model, limit=2)
+    if len(candidates) < 2:
+        return read(candidates[0])
+
+    cluster, key, _ = router.read_target(model)
+    state = router.state()
+
+    def run(alias):
+        router.init(state, cluster.name)
+        router.context.chosen[key] = alias
+        started = default_timer()
+        try:
+            result = read(alias)
+        finally:
+            router.reset()
+            # Pool threads keep connections between reads, like requests do.
+            connections[alias].close_if_unusable_or_obsolete()
+        latencies.record(default_timer() - started)
+        return result
+
+    executor = get_executor('Hedged reads', settings.REPLICATED_HEDGE_WORKERS)
+    if delay is None:
+        delay = hedge_delay()
+
+    pending = [executor.submit(run, candidates[0])]
+    done, _ = futures.wait(pending, timeout=delay)
+    if not done or pending[0].exception() is not None:
+        log.debug('hedging read to %s', candidates[1])
+        if metrics.enabled:
+            metrics.incr('hedged_reads', alias=candidates[1])
+        pending.append(executor.submit(run, candidates[1]))
+
+    error = None
+    while pending:
+        done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+        for future in done:
+            pending.remove(future)
+            if future.exception() is None:
+                for loser in pending:
+                    loser.cancel()
+                return future.result()
+            error = error or future.exception()
+
+    raise error
+
+
+def hedged_queryset(queryset, delay=None):
+    '''
+    Evaluates the queryset with ``hedged_read`` and returns a list of results.
+    '''
+    return hedged_read(lambda alias: list(queryset.using(alias)), queryset.model, delay)
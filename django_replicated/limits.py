@@ -0,0 +1,142 @@
+# coding: utf-8
+'''
+Load shedding for slaves.
+
+Every slave can have a limit of concurrent operations (web requests) using
+it and a limit of operations starting per second. When the best slave is
+saturated the router takes the next one, then the master within its own
+budget of reads, and finally the best slave anyway: reads are never refused.
+
+Concurrent operations are the routing contexts that chose the slave, they
+are counted from ``ReplicationRouter.init`` until the next ``reset`` (which
+is what ``ReplicationMiddleware`` does for every request). Operations
+without ``init``, e.g. code in ``use_slave`` blocks, only count towards
+rates.
+
+Counters are kept in process memory, or in the cache backend with
+``shared=True`` to limit the whole cluster of application servers. Shared
+counters of concurrent operations expire ``SHARED_TIMEOUT`` seconds after
+they were last changed so that counts of crashed processes do not stick
+(the expiry is only extended by cache backends with ``touch``, Django 2.1+).
+'''
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+SHARED_TIMEOUT = 60
+
+
+class Limiter(object):
+    '''
+    ``limits`` maps a name (slave alias) to a dict with optional
+    "concurrency" and "rate" (per second) items.
+    '''
+    def __init__(self, limits, cache=None, prefix='replicated:limits', clock=time.time):
+        self.limits = dict(limits)
+        self.cache = cache
+        self.prefix = prefix
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._rates = {}
+
+    def __contains__(self, name):
+        return name in self.limits
+
+    def key(self, *parts):
+        return ':'.join((self.prefix,) + tuple('%s' % part for part in parts))
+
+    def acquire(self, name, track=True):
+        '''
+        Takes a slot of ``name`` if it is not saturated. With ``track``
+        the slot must be returned with ``release``.
+        '''
+        limit = self.limits.get(name)
+        if limit is None:
+            return True
+
+        concurrency = limit.get('concurrency') if track else None
+        rate = limit.get('rate')
+
+        if self.cache is not None:
+            return self._acquire_shared(name, concurrency, rate)
+
+        second = int(self.clock())
+        with self._lock:
+            if concurrency is not None and self._inflight.get(name, 0) >= concurrency:
+                return False
+
+            if rate is not None:
+                window, count = self._rates.get(name, (second, 0))
+                if window != second:
+                    count = 0
+                if count >= rate:
+                    return False
+                self._rates[name] = second, count + 1
+
+            if concurrency is not None:
+                self._inflight[name] = self._inflight.get(name, 0) + 1
+        return True
+
+    def _acquire_shared(self, name, concurrency, rate):
+        if concurrency is not None:
+            key = self.key(name, 'inflight')
+            self.cache.add(key, 0, SHARED_TIMEOUT)
+            inflight = self._incr(key, 1)
+            self._touch(key)
+            if inflight > concurrency:
+                self._incr(key, -1)
+                return False
+
+        if rate is not None:
+            key = self.key(name, 'rate', int(self.clock()))
+            self.cache.add(key, 0, 2)
+            if self._incr(key, 1) > rate:
+                if concurrency is not None:
+                    self._incr(self.key(name, 'inflight'), -1)
+                return False
+
+        return True
+
+    def _incr(self, key, delta):
+        try:
+            return self.cache.incr(key, delta)
+        except ValueError:
+            # The key has expired in the meantime
+            return 0
+
+    def _touch(self, key):
+        # incr does not extend the expiry, without it a busy counter would
+        # reset every SHARED_TIMEOUT seconds and then go below the real count
+        touch = getattr(self.cache, 'touch', None)  # django 2.1+
+        if touch is not None:
+            touch(key, SHARED_TIMEOUT)
+
+    def release(self, name):
+        limit = self.limits.get(name)
+        if limit is None or limit.get('concurrency') is None:
+            return
+
+        if self.cache is not None:
+            key = self.key(name, 'inflight')
+            if self._incr(key, -1) < 0:
+                # Taken before the counter expired
+                self._incr(key, 1)
+            self._touch(key)
+            return
+
+        with self._lock:
+            inflight = self._inflight.get(name, 0)
+            if inflight > 0:
+                self._inflight[name] = inflight - 1
+
+    def inflight(self, name):
+        if self.cache is not None:
+            return self.cache.get(self.key(name, 'inflight')) or 0
+        return self._inflight.get(name, 0)
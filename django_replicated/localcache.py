@@ -0,0 +1,151 @@
+# coding: utf-8
+'''
+In-process cache tier in front of a Django cache backend.
+
+Health checks read their marks from the cache on every request. With a
+network cache backend (memcached, redis) this is a round trip per database
+per request, even when all databases are fine. ``TieredCache`` keeps
+results of these lookups, including misses, in process memory for a short
+time, so that the shared backend is only consulted once per that time.
+'''
+from __future__ import unicode_literals
+
+import threading
+from collections import OrderedDict
+from timeit import default_timer
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+
+# Marks a cached miss of the shared backend, i.e. absence of a value.
+MISSING = object()
+
+# Marks absence of a key in the local tier.
+ABSENT = object()
+
+
+class LocalCache(object):
+    '''
+    Thread-safe TTL cache bounded by size, evicting least recently used
+    entries first.
+    '''
+    def __init__(self, max_size=1024, clock=default_timer):
+        self.max_size = max_size
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return default
+
+            expires, value = item
+            if expires <= self.clock():
+                return default
+
+            # Reinserting moves the key to the most recently used end.
+            self._data[key] = item
+            return value
+
+    def set(self, key, value, timeout):
+        if timeout <= 0:
+            self.delete(key)
+            return
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (self.clock() + timeout, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TieredCache(object):
+    '''
+    Read-through, write-through wrapper of a Django cache backend with
+    a local tier. Values, including absent ones, are served locally for
+    at most ``local_seconds`` (and never longer than their own timeout).
+    With zero ``local_seconds`` all calls go straight to the backend.
+    '''
+    def __init__(self, shared, local_seconds=0, max_size=1024):
+        self.shared = shared
+        self.local_seconds = local_seconds
+        self.local = LocalCache(max_size)
+
+    def get(self, key, default=None):
+        if not self.local_seconds:
+            return self.shared.get(key, default)
+
+        value = self.local.get(key, ABSENT)
+        if value is ABSENT:
+            value = self.shared.get(key, MISSING)
+            self.local.set(key, value, self.local_seconds)
+
+        return default if value is MISSING else value
+
+    def get_many(self, keys):
+        '''
+        Returns a dict of found values like ``cache.get_many``, asking the
+        shared backend only for keys missing locally in one call.
+        '''
+        if not self.local_seconds:
+            return self.shared.get_many(keys)
+
+        result = {}
+        missing = []
+        for key in keys:
+            value = self.local.get(key, ABSENT)
+            if value is ABSENT:
+                missing.append(key)
+            elif value is not MISSING:
+                result[key] = value
+
+        if missing:
+            found = self.shared.get_many(missing)
+            for key in missing:
+                value = found.get(key, MISSING)
+                self.local.set(key, value, self.local_seconds)
+                if value is not MISSING:
+                    result[key] = value
+
+        return result
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        self.shared.set(key, value, timeout)
+        self._set_local(key, value, timeout)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT):
+        self.shared.set_many(data, timeout)
+        for key, value in data.items():
+            self._set_local(key, value, timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT):
+        # Used for locks, must always be atomic in the shared backend.
+        added = self.shared.add(key, value, timeout)
+        if added:
+            self._set_local(key, value, timeout)
+        return added
+
+    def delete(self, key):
+        self.shared.delete(key)
+        self.local.delete(key)
+
+    def _set_local(self, key, value, timeout):
+        if not self.local_seconds:
+            return
+        local_timeout = self.local_seconds
+        if timeout is not None and timeout is not DEFAULT_TIMEOUT:
+            local_timeout = min(local_timeout, timeout)
+        self.local.set(key, value, local_timeout)
@@ -0,0 +1,205 @@
+# coding: utf-8
+'''
+Health report of all databases known to the replication router.
+
+    ./manage.py replicated_status
+    ./manage.py replicated_status --iterations 20 --json
+    ./manage.py replicated_status --watch 5
+    ./manage.py replicated_status --check  # exit status 1 if any is dead
+
+Databases are probed concurrently, directly, without reading or setting
+dead marks, so the report shows both the actual state and what the
+application currently thinks of it.
+
+Latency is reported for opening a new connection ("connect") and for
+liveness checks (ping or ``SELECT 1``) over that open connection, i.e.
+server round trips ("p50" .. "max").
+'''
+from __future__ import unicode_literals
+
+import json
+import threading
+import time
+from timeit import default_timer
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from django_replicated import dbchecker
+from django_replicated.breaker import CircuitBreaker
+from django_replicated.utils import routers
+
+
+def percentile(samples, percent):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100.0))]
+
+
+def probe(alias, iterations, report):
+    latencies = []
+    alive = writable = False
+    lag = connect = None
+    try:
+        # Probes run in new threads, without open connections
+        started = default_timer()
+        try:
+            connections[alias].ensure_connection()
+        except Exception:
+            pass
+        else:
+            connect = default_timer() - started
+
+        for _ in range(iterations):
+            started = default_timer()
+            alive = dbchecker.run_checker(dbchecker.is_alive, alias)
+            latencies.append(default_timer() - started)
+
+        writable = alive and dbchecker.run_checker(dbchecker.is_writable, alias)
+        if alive:
+            try:
+                lag = dbchecker.replication_lag(connections[alias])
+            except Exception:
+                pass
+    finally:
+        connections[alias].close()
+
+    report.update({
+        'alive': alive,
+        'writable': writable,
+        'lag': lag,
+        'latency': {
+            'connect': connect,
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies) if latencies else None,
+        },
+    })
+
+
+def cached_state(alias):
+    '''
+    What the application currently thinks of the database.
+    '''
+    state = {}
+    for checker in (dbchecker.is_alive, dbchecker.is_writable):
+        key = dbchecker.get_cache_key(checker.__name__, alias)
+        if settings.REPLICATED_CIRCUIT_BREAKER:
+            breaker = CircuitBreaker(dbchecker.cache, key + ':breaker', settings.REPLICATED_DATABASE_DOWNTIME)
+            state[checker.__name__] = breaker.state()
+        else:
+            state[checker.__name__] = 'dead' if dbchecker.cache.get(key) == dbchecker.DEAD_MARK else 'ok'
+
+    # Background probing runs in application processes, only a shared
+    # snapshot is visible here.
+    prober = routers.router.prober
+    if prober is not None and prober.shared:
+        shared = dbchecker.cache.get(prober.snapshot_key)
+        if shared is not None and alias in shared[1]:
+            state['prober'] = dict(shared[1][alias]._asdict(), updated=shared[0])
+    return state
+
+
+def collect(aliases, iterations):
+    router = routers.router
+    reports = []
+    threads = []
+    for alias in aliases:
+        cluster = router.alias_clusters.get(alias)
+        report = {
+            'alias': alias,
+            'cluster': cluster.name if cluster is not None else None,
+            'role': 'master' if cluster is not None and cluster.master == alias else 'slave',
+            'cached': cached_state(alias),
+        }
+        reports.append(report)
+        threads.append(threading.Thread(target=probe, args=(alias, iterations, report)))
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return reports
+
+
+def jsonable(reports):
+    # JSON has no infinity, used for lag of stopped replication
+    for report in reports:
+        if report['lag'] == float('inf'):
+            report['lag'] = 'inf'
+    return reports
+
+
+def format_seconds(value):
+    if value is None:
+        return '-'
+    return '%.1f' % (value * 1000)
+
+
+def format_lag(value):
+    if value is None:
+        return '-'
+    if value == float('inf'):
+        return 'stopped'
+    return '%.1f' % value
+
+
+class Command(BaseCommand):
+    help = 'Probes all replicated databases and reports their health.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('aliases', nargs='*', help='databases to probe, all by default')
+        parser.add_argument('--iterations', type=int, default=1, help='number of liveness queries per database')
+        parser.add_argument('--json', action='store_true', help='output JSON, a line per report')
+        parser.add_argument('--watch', type=float, default=0, help='repeat every WATCH seconds')
+        parser.add_argument('--check', action='store_true', help='fail if any database is dead')
+
+    def handle(self, *args, **options):
+        aliases = options['aliases'] or routers.router.all_allowed_aliases
+        unknown = [alias for alias in aliases if alias not in connections.databases]
+        if unknown:
+            raise CommandError('Unknown databases: %s' % ', '.join(unknown))
+
+        while True:
+            reports = collect(aliases, max(1, options['iterations']))
+            if options['json']:
+                self.stdout.write(json.dumps({'time': time.time(), 'databases': jsonable(reports)}, sort_keys=True))
+            else:
+                self.write_table(reports)
+
+            if not options['watch']:
+                break
+            try:
+                time.sleep(options['watch'])
+            except KeyboardInterrupt:
+                break
+
+        dead = [report['alias'] for report in reports if not report['alive']]
+        if options['check'] and dead:
+            raise CommandError('Databases are not alive: %s' % ', '.join(dead))
+
+    def write_table(self, reports):
+        row = '%-16s %-10s %-6s %-5s %-8s %8s %11s %8s %8s %8s %8s  %s'
+        self.stdout.write(time.strftime('%Y-%m-%d %H:%M:%S'))
+        self.stdout.write(row % (
+            'alias', 'cluster', 'role', 'alive', 'writable', 'lag, s',
+            'connect, ms', 'p50, ms', 'p90, ms', 'p99, ms', 'max, ms', 'cached state',
+        ))
+        for report in reports:
+            latency = report['latency']
+            cached = ', '.join(
+                '%s: %s' % (name, value) for name, value in sorted(report['cached'].items())
+                if name != 'prober'
+            )
+            self.stdout.write(row % (
+                report['alias'], report['cluster'] or '-', report['role'],
+                'yes' if report['alive'] else 'NO', 'yes' if report['writable'] else 'no',
+                format_lag(report['lag']),
+                format_seconds(latency['connect']), format_seconds(latency['p50']), format_seconds(latency['p90']),
+                format_seconds(latency['p99']), format_seconds(latency['max']),
+                cached,
+            ))
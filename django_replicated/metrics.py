@@ -0,0 +1,212 @@
+# coding: utf-8
+'''
+Instrumentation of routing and health check decisions.
+
+Code reports events to the process-wide ``metrics`` object, which passes
+them to configured sinks. Without sinks reporting costs a single attribute
+check: call sites test ``metrics.enabled`` before building any arguments.
+
+Sinks are configured with ``REPLICATED_METRICS_SINKS``, a list of import
+paths of sink classes, sink instances or plain callables, or added with
+``metrics.add_sink``. A sink has two methods:
+
+    incr(name, value, tags)      # counter
+    observe(name, value, tags)   # histogram, value in seconds
+
+where ``tags`` is a tuple of (name, value) pairs.
+
+Metrics:
+
+    reads                  alias          reads routed to a database
+    writes                 alias          writes routed to a database
+    fallbacks_to_master    cluster        no suitable slave, master used
+    spills_to_master       cluster        all slaves saturated, master used
+    saturated              cluster        all slaves and master budget saturated
+    dead_mark_hits         alias, check   check skipped, database is dead
+    dead_mark_misses       alias, check   check performed
+    probe_seconds          alias, check   check duration (histogram)
+    check_timeouts         alias          checks not finished in time
+    master_failovers       cluster, alias another database found writable
+    override_matches       state          REPLICATED_VIEWS_OVERRIDES matches
+    force_master_cookies                  read-after-write cookies set
+    hedged_reads           alias          reads duplicated to a second slave
+    query_cache_hits                      results served from the query cache
+    query_cache_misses                    results read from a database
+'''
+from __future__ import unicode_literals
+
+import threading
+
+import six
+
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metrics(object):
+    def __init__(self):
+        self.sinks = []
+        self.enabled = False
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        self.enabled = True
+
+    def clear(self):
+        self.sinks = []
+        self.enabled = False
+
+    def configure(self, sinks):
+        self.clear()
+        for sink in sinks:
+            self.add_sink(load_sink(sink))
+
+    def incr(self, name, value=1, **tags):
+        tags = tuple(sorted(tags.items()))
+        for sink in self.sinks:
+            sink.incr(name, value, tags)
+
+    def observe(self, name, value, **tags):
+        tags = tuple(sorted(tags.items()))
+        for sink in self.sinks:
+            sink.observe(name, value, tags)
+
+
+metrics = Metrics()
+
+
+def load_sink(sink):
+    if isinstance(sink, six.string_types):
+        from django.utils.module_loading import import_string
+        sink = import_string(sink)
+
+    if isinstance(sink, type):
+        return sink()
+    if hasattr(sink, 'incr') and hasattr(sink, 'observe'):
+        return sink
+    if callable(sink):
+        return CallbackSink(sink)
+
+    raise ValueError('Not a metrics sink: %r' % (sink,))
+
+
+class CallbackSink(object):
+    '''
+    Passes metrics to a callable as ``callback(kind, name, value, tags)``
+    where kind is "counter" or "histogram".
+    '''
+    def __init__(self, callback):
+        self.callback = callback
+
+    def incr(self, name, value, tags):
+        self.callback('counter', name, value, tags)
+
+    def observe(self, name, value, tags):
+        self.callback('histogram', name, value, tags)
+
+
+class StatsdSink(object):
+    '''
+    Sends metrics to a StatsD client with ``incr(stat, count)`` and
+    ``timing(stat, milliseconds)`` methods. Tags become parts of names.
+    '''
+    def __init__(self, client, prefix='replicated'):
+        self.client = client
+        self.prefix = prefix
+
+    def stat(self, name, tags):
+        return '.'.join([self.prefix, name] + [value for _, value in tags])
+
+    def incr(self, name, value, tags):
+        self.client.incr(self.stat(name, tags), value)
+
+    def observe(self, name, value, tags):
+        self.client.timing(self.stat(name, tags), value * 1000)
+
+
+class InMemorySink(object):
+    '''
+    Keeps counters and histograms in process memory. Can render them
+    in Prometheus text format.
+    '''
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, value, tags):
+        key = (name, tags)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, tags):
+        key = (name, tags)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # Counts per bucket, then sum and count of all values
+                histogram = self.histograms[key] = [0] * len(self.buckets) + [0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def counter(self, name, **tags):
+        return self.counters.get((name, tuple(sorted(tags.items()))), 0)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def render_prometheus(self, prefix='replicated_'):
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(value)) for key, value in self.histograms.items())
+
+        lines = []
+        typed = set()
+        for (name, tags), value in counters:
+            name = '%s%s_total' % (prefix, name)
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, format_labels(tags), value))
+
+        for (name, tags), histogram in histograms:
+            name = prefix + name
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            for bound, count in zip(self.buckets, histogram):
+                lines.append('%s_bucket%s %s' % (name, format_labels(tags + (('le', repr(float(bound))),)), count))
+            lines.append('%s_bucket%s %s' % (name, format_labels(tags + (('le', '+Inf'),)), histogram[-1]))
+            lines.append('%s_sum%s %s' % (name, format_labels(tags), histogram[-2]))
+            lines.append('%s_count%s %s' % (name, format_labels(tags), histogram[-1]))
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(tags):
+    if not tags:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, six.text_type(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in tags
+    )
+
+
+def prometheus_view(request):
+    '''
+    Django view exposing metrics of all ``InMemorySink`` sinks
+    in Prometheus text format.
+    '''
+    from django.http import HttpResponse
+
+    body = ''.join(
+        sink.render_prometheus() for sink in metrics.sinks
+        if isinstance(sink, InMemorySink)
+    )
+    return HttpResponse(body, content_type='text/plain; version=0.0.4')
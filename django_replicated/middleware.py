@@ -1,9 +1,11 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
+import base64
 import inspect
 import logging
 import fnmatch
+import re
 import types
 from functools import partial
 import six
@@ -25,13 +27,163 @@ except ImportError:
             pass
 
 from . import dbchecker
+from .metrics import metrics
 from .utils import routers, get_object_name
 
+if six.PY3:
+    from .aio import AsyncMiddlewareMixin
+else:
+    class AsyncMiddlewareMixin(object):
+        pass
+
 
 log = logging.getLogger(__name__)
 
 
-class ReplicationMiddleware(MiddlewareMixin):
+POSITION_PREFIX = 'pos:'
+
+
+def encode_position(position):
+    '''
+    Encodes replication position into a cookie-safe string.
+    '''
+    data = base64.urlsafe_b64encode(position.encode('utf-8')).decode('ascii')
+    return POSITION_PREFIX + data.rstrip('=')
+
+
+def decode_position(value):
+    '''
+    Decodes replication position encoded by ``encode_position``,
+    returns None for other and malformed values.
+    '''
+    if not value or not value.startswith(POSITION_PREFIX):
+        return None
+
+    data = value[len(POSITION_PREFIX):]
+    data += '=' * (-len(data) % 4)
+    try:
+        return base64.urlsafe_b64decode(data.encode('ascii')).decode('utf-8') or None
+    except (TypeError, ValueError):
+        return None
+
+
+def translate_glob(pattern):
+    regex = fnmatch.translate(pattern)
+    # Python < 3.6 appends global flags which can not be used
+    # in the middle of a combined pattern.
+    if regex.endswith('(?ms)'):
+        regex = regex[:-len('(?ms)')]
+    return regex
+
+
+class ViewOverrides(object):
+    '''
+    ``REPLICATED_VIEWS_OVERRIDES`` compiled into indexes: dicts of url names,
+    view names and view import paths, and a single regular expression for
+    url path patterns. Keys starting with "/" are only treated as path
+    patterns, so when there are only such keys urls are not resolved at all.
+    If several entries match, the first one in the overrides wins.
+    '''
+    # Maximum number of paths to remember url resolving results for
+    resolve_cache_size = 1024
+
+    def __init__(self, overrides):
+        self.overrides = overrides
+        self.states = []
+        self.url_names = {}
+        self.view_names = {}
+        self.import_paths = {}
+
+        globs = []
+        for position, (lookup_view, forced_state) in enumerate(six.iteritems(overrides)):
+            self.states.append(forced_state)
+
+            if not lookup_view.startswith('/'):
+                names = self.view_names if ':' in lookup_view else self.url_names
+                names.setdefault(lookup_view, position)
+                self.import_paths.setdefault(lookup_view, position)
+
+            # Only patterns that can match a path starting with "/"
+            if lookup_view[:1] in ('/', '*', '?', '['):
+                globs.append('(?P<o%d>%s)' % (position, translate_glob(lookup_view)))
+
+        self.globs = re.compile('|'.join(globs), re.S) if globs else None
+        self.needs_resolve = bool(self.import_paths)
+        self._resolved = {}
+
+    def resolve(self, path):
+        key = (urls.get_urlconf(), path)
+        try:
+            return self._resolved[key]
+        except KeyError:
+            pass
+
+        match = urls.resolve(path)
+        import_path = '%s.%s' % (get_object_name(inspect.getmodule(match.func)),
+                                 get_object_name(match.func))
+        result = (match.url_name, match.view_name, import_path)
+
+        if len(self._resolved) >= self.resolve_cache_size:
+            self._resolved.clear()
+        self._resolved[key] = result
+        return result
+
+    def match(self, path):
+        position = None
+
+        if self.globs is not None:
+            match = self.globs.match(path)
+            if match is not None:
+                # The outer group of an alternative closes last.
+                position = int(match.lastgroup[1:])
+
+        if self.needs_resolve:
+            url_name, view_name, import_path = self.resolve(path)
+            for index, key in ((self.url_names, url_name),
+                               (self.view_names, view_name),
+                               (self.import_paths, import_path)):
+                found = index.get(key)
+                if found is not None and (position is None or found < position):
+                    position = found
+
+        if position is not None:
+            return self.states[position]
+
+
+class NonAtomicDatabases(object):
+    '''
+    ``_non_atomic_requests`` of a view with ``REPLICATED_MANAGE_ATOMIC_REQUESTS``:
+    all databases except the one the current request reads from, and the
+    ones declared non-atomic by the view itself. Membership is looked up
+    in the routing context of the current thread, so the view is changed
+    only once and concurrent requests in different states do not race.
+    '''
+    def __init__(self, declared, aliases):
+        self.declared = frozenset(declared)
+        self.aliases = frozenset(aliases)
+        self.by_alias = dict(
+            (alias, (self.aliases - {alias}) | self.declared) for alias in self.aliases
+        )
+
+    def current(self):
+        # In master state the alias for reads is the one for writes
+        alias = routers.router.read_alias()
+        try:
+            return self.by_alias[alias]
+        except KeyError:
+            return self.aliases | self.declared
+
+    def __contains__(self, alias):
+        return alias in self.current()
+
+    def __iter__(self):
+        return iter(self.current())
+
+    def __len__(self):
+        return len(self.current())
+
+
+class ReplicationMiddleware(AsyncMiddlewareMixin, MiddlewareMixin):
     '''
     Middleware for automatically switching routing state to
     master or slave depending on request method.
@@ -50,6 +202,10 @@ class ReplicationMiddleware(MiddlewareMixin):
         super(ReplicationMiddleware, self).__init__(get_response=get_response)
 
         self.forced_state = forced_state
+        self._overrides_index = None
+
+        # Fail early if the router is not installed
+        routers.router
 
     def process_request(self, request):
         if self.forced_state is not None:
@@ -69,28 +225,54 @@ class ReplicationMiddleware(MiddlewareMixin):
             log.debug('state after override: %s', state)
 
             log.debug('init state: %s', state)
-        routers.init(state)
+        router = routers.router
+        router.init(state)
+
+        if settings.REPLICATED_READ_YOUR_WRITES:
+            position = decode_position(request.COOKIES.get(settings.REPLICATED_FORCE_MASTER_COOKIE_NAME))
+            if position is not None:
+                log.debug('require replication position: %s', position)
+                router.require_position(position)
+
+        affinity_key = self.get_affinity_key(request)
+        if affinity_key is not None:
+            router.set_affinity(affinity_key)
+
+    def get_affinity_key(self, request):
+        '''
+        Client key for ``REPLICATED_AFFINITY``: session id from the cookie
+        for "session", authenticated user id from the session for "user",
+        or the result of a callable (or its import path) taking the request.
+        '''
+        affinity = settings.REPLICATED_AFFINITY
+        if not affinity:
+            return None
+
+        if affinity == 'session':
+            return request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+
+        if affinity == 'user':
+            from django.contrib.auth import SESSION_KEY
+            session = getattr(request, 'session', None)
+            return session.get(SESSION_KEY) if session is not None else None
+
+        if isinstance(affinity, six.string_types):
+            from django.utils.module_loading import import_string
+            affinity = import_string(affinity)
+
+        return affinity(request)
 
     def set_non_atomic_dbs(self, view):
+        '''
+        Makes requests to the view atomic only on the database they read
+        from (see ``NonAtomicDatabases``), installed on the first request.
+        '''
         if isinstance(view, types.MethodType):
             view = six.get_method_function(view)
 
-        default_attr = '_replicated_view_default_non_atomic_dbs'
-        default_set = getattr(view, default_attr, None)
-        # If default_set is None then this first request. Set default.
-        if default_set is None:
-            view_set = getattr(view, '_non_atomic_requests', set())
-            setattr(view, default_attr, view_set)
-            default_set = view_set
-
-        all_allowed_aliases = routers.all_allowed_aliases
-        # If state master db_for_read() == db_for_write()
-        current_alias = routers.db_for_read()
-        not_used_aliases = set(
-            a for a in all_allowed_aliases
-            if a != current_alias
-        )
-        view._non_atomic_requests = not_used_aliases | default_set
+        non_atomic = getattr(view, '_non_atomic_requests', ())
+        if not isinstance(non_atomic, NonAtomicDatabases):
+            view._non_atomic_requests = NonAtomicDatabases(non_atomic, routers.router.all_allowed_aliases)
 
     def process_view(self, request, view, *args):
         if settings.REPLICATED_MANAGE_ATOMIC_REQUESTS:
@@ -98,9 +280,36 @@ class ReplicationMiddleware(MiddlewareMixin):
 
     def process_response(self, request, response):
         self.handle_redirect_after_write(request, response)
-        routers.reset()
+        routers.router.reset()
         return response
 
+    def request_blocks(self, request):
+        '''
+        Whether ``process_request`` may do blocking I/O: loading the session
+        for 'user' affinity, calling a custom affinity function or releasing
+        shared limiter slots.
+        '''
+        affinity = settings.REPLICATED_AFFINITY
+        return bool(affinity and affinity != 'session') or self.releases_shared_slots()
+
+    def response_blocks(self, request, response):
+        '''
+        Whether ``process_response`` may do blocking I/O: reading the master
+        replication position (and discovering the master) for the cookie
+        or releasing shared limiter slots.
+        '''
+        if (
+            settings.REPLICATED_READ_YOUR_WRITES and
+            response.status_code in settings.REPLICATED_FORCE_MASTER_COOKIE_STATUS_CODES and
+            routers.router.state() == 'master'
+        ):
+            return True
+        return self.releases_shared_slots()
+
+    def releases_shared_slots(self):
+        router = routers.router
+        return router.limiter is not None and router.limiter.cache is not None and bool(router.context.held)
+
     def check_state_override(self, request, state):
         '''
         Used to check if a web request should use a master or slave
@@ -111,6 +320,8 @@ class ReplicationMiddleware(MiddlewareMixin):
 
         override_state = self.get_state_override(request)
         if override_state is not None:
+            if metrics.enabled:
+                metrics.incr('override_matches', state=override_state)
             state = override_state
         return state
 
@@ -120,24 +331,11 @@ class ReplicationMiddleware(MiddlewareMixin):
         if not overrides:
             return
 
-        match = urls.resolve(request.path_info)
-
-        import_path = '%s.%s' % (get_object_name(inspect.getmodule(match.func)),
-                                 get_object_name(match.func))
+        index = self._overrides_index
+        if index is None or index.overrides is not overrides:
+            index = self._overrides_index = ViewOverrides(overrides)
 
-        for lookup_view, forced_state in six.iteritems(overrides):
-            if (
-                self.is_override_matched(match, lookup_view) or
-                import_path == lookup_view or
-                fnmatch.fnmatchcase(request.path_info, lookup_view)
-            ):
-                return forced_state
-
-    def is_override_matched(self, match, lookup_view):
-        if ':' in lookup_view:
-            return match.view_name == lookup_view
-        else:
-            return match.url_name == lookup_view
+        return index.match(request.path_info)
 
     def handle_redirect_after_write(self, request, response):
         '''
@@ -147,9 +345,18 @@ class ReplicationMiddleware(MiddlewareMixin):
         replicas lagging behind on updates a little.
         '''
         force_master_codes = settings.REPLICATED_FORCE_MASTER_COOKIE_STATUS_CODES
-        if response.status_code in force_master_codes and routers.state() == 'master':
-            log.debug('set force master cookie for %s', request.path)
-            self.set_force_master_cookie(response)
+        router = routers.router
+        if response.status_code in force_master_codes and router.state() == 'master':
+            position = None
+            if settings.REPLICATED_READ_YOUR_WRITES:
+                position = dbchecker.get_replication_position(router.master_for())
+
+            if position is not None:
+                log.debug('set replication position cookie for %s: %s', request.path, position)
+                self.set_position_cookie(response, position)
+            else:
+                log.debug('set force master cookie for %s', request.path)
+                self.set_force_master_cookie(response)
         else:
             if settings.REPLICATED_FORCE_MASTER_COOKIE_NAME in request.COOKIES:
                 response.delete_cookie(settings.REPLICATED_FORCE_MASTER_COOKIE_NAME)
@@ -158,17 +365,34 @@ class ReplicationMiddleware(MiddlewareMixin):
         '''
         Use it to explicitly use master on next request to your app.
         '''
+        if metrics.enabled:
+            metrics.incr('force_master_cookies')
         response.set_cookie(settings.REPLICATED_FORCE_MASTER_COOKIE_NAME, 'true',
                             max_age=settings.REPLICATED_FORCE_MASTER_COOKIE_MAX_AGE)
 
+    def set_position_cookie(self, response, position):
+        '''
+        Makes next request to your app read from slaves that have
+        replayed the master replication position, or from master.
+        '''
+        if metrics.enabled:
+            metrics.incr('force_master_cookies')
+        response.set_cookie(settings.REPLICATED_FORCE_MASTER_COOKIE_NAME, encode_position(position),
+                            max_age=settings.REPLICATED_FORCE_MASTER_COOKIE_MAX_AGE)
+
 
 class ReadOnlyMiddleware(MiddlewareMixin):
     def process_request(self, request):
         request.service_is_readonly = functional.SimpleLazyObject(self.is_service_read_only)
 
     def is_service_read_only(self):
+        master = db.DEFAULT_DB_ALIAS
+        if settings.REPLICATED_MASTER_DISCOVERY:
+            router = routers.router
+            master = router.current_master(router.default_cluster)
+
         do_check = partial(dbchecker.check_db,
-                           db_name=db.DEFAULT_DB_ALIAS,
+                           db_name=master,
                            cache_seconds=settings.REPLICATED_READ_ONLY_DOWNTIME,
                            number_of_tries=settings.REPLICATED_READ_ONLY_TRIES)
 
@@ -0,0 +1,146 @@
+# coding: utf-8
+'''
+Background health probing of databases.
+
+``HealthProber`` periodically checks every database in a background thread
+and keeps a snapshot of results in memory, so that the router does not make
+checks (and wait for hanging databases) while handling requests.
+
+In shared mode only one process on a host probes databases at a time and
+publishes the snapshot to the cache backend, other processes just fetch it.
+'''
+from __future__ import unicode_literals
+
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+from django.db import connections
+
+from . import dbchecker
+
+
+log = logging.getLogger(__name__)
+
+
+Health = namedtuple('Health', 'alive writable lag')
+
+
+class HealthProber(object):
+    # Snapshot older than this number of intervals is ignored
+    # and the router falls back to inline checks.
+    max_missed_intervals = 3
+
+    def __init__(self, aliases, interval, downtime=None, lag_cache_seconds=None, shared=False):
+        self.aliases = list(aliases)
+        self.interval = interval
+        self.downtime = downtime
+        self.lag_cache_seconds = lag_cache_seconds
+        self.shared = shared
+
+        self.snapshot = {}
+        self.updated = None
+
+        self.snapshot_key = ':'.join((dbchecker.hostname, 'health_snapshot'))
+        self.lock_key = ':'.join((dbchecker.hostname, 'health_prober'))
+
+        self._thread = None
+        self._pid = None
+        self._stopped = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def probe_one(self, alias):
+        alive = dbchecker.check_db(dbchecker.is_alive, alias, self.downtime, force=True)
+        if not alive:
+            return Health(False, False, None)
+
+        writable = dbchecker.check_db(dbchecker.is_writable, alias, force=True)
+        lag = dbchecker.check_replication_lag(alias, self.lag_cache_seconds, force=True)
+        return Health(True, writable, lag)
+
+    def probe(self):
+        return dict((alias, self.probe_one(alias)) for alias in self.aliases)
+
+    def run_once(self):
+        try:
+            self.probe_round()
+        finally:
+            # There is no request cycle in the probing thread
+            for alias in self.aliases:
+                connections[alias].close_if_unusable_or_obsolete()
+
+    def probe_round(self):
+        if not self.shared:
+            self.publish(self.probe(), time.time())
+            return
+
+        if dbchecker.cache.add(self.lock_key, os.getpid(), self.interval):
+            updated = time.time()
+            snapshot = self.probe()
+            dbchecker.cache.set(self.snapshot_key, (updated, snapshot), self.interval * self.max_missed_intervals)
+            self.publish(snapshot, updated)
+        else:
+            shared = dbchecker.cache.get(self.snapshot_key)
+            if shared is not None:
+                updated, snapshot = shared
+                self.publish(snapshot, updated)
+
+    def publish(self, snapshot, updated):
+        # Readers take the snapshot without locking, so it is replaced
+        # as a whole, never modified in place.
+        self.snapshot = snapshot
+        self.updated = updated
+        log.debug('Health snapshot: %s', snapshot)
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                log.exception('Error probing databases')
+            self._stopped.wait(self.interval)
+
+    def ensure_running(self):
+        '''
+        Starts probing thread if it is not running in the current process.
+        Threads do not survive fork, so a forked worker starts its own one.
+        '''
+        pid = os.getpid()
+        if self._pid == pid and self._thread is not None:
+            return
+
+        with self._start_lock:
+            if self._pid == pid and self._thread is not None:
+                return
+
+            self._stopped.clear()
+            self.snapshot = {}
+            self.updated = None
+            self._thread = threading.Thread(target=self.run, name='django_replicated.prober')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = pid
+
+    def stop(self):
+        self._stopped.set()
+        self._thread = None
+        self._pid = None
+
+    def current(self):
+        '''
+        Returns the latest snapshot or None if it is missing or stale.
+        '''
+        self.ensure_running()
+
+        updated = self.updated
+        if updated is None or time.time() - updated > self.interval * self.max_missed_intervals:
+            return None
+        return self.snapshot
+
+    def health(self, alias):
+        snapshot = self.current()
+        if snapshot is None:
+            return None
+        return snapshot.get(alias)
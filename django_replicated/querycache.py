@@ -0,0 +1,167 @@
+# coding: utf-8
+'''
+Cache of query results read from slaves.
+
+Results of querysets evaluated with ``cached_queryset`` in slave state are
+kept in process memory (``REPLICATED_QUERY_CACHE_TIMEOUT`` seconds at most,
+``REPLICATED_QUERY_CACHE_SIZE`` entries, least recently used evicted first).
+
+Consistency: every write to a table through the router (``db_for_write``,
+``post_save``, ``post_delete``, ``m2m_changed``) stores the time of the
+write in the cache backend, so it is seen by all processes, and stores it
+again when the transaction of the write commits. An entry is
+tagged with write times of its tables and is only used while they have not
+changed. Results of tables written less than ``REPLICATED_QUERY_CACHE_SETTLE``
+seconds ago are not cached at all, since slaves may not have replayed these
+writes yet. Thus a cached result is never older than a result that could
+be read from a slave lagging by that time.
+
+Only tables joined by the query itself are tracked, not tables of subqueries.
+Reads with a required replication position (read-your-writes) bypass the cache.
+'''
+from __future__ import unicode_literals
+
+import hashlib
+import logging
+import time
+from functools import partial
+
+from django.conf import settings
+from django.db import connections, transaction
+
+try:  # django 1.11+
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+from .localcache import LocalCache
+from .metrics import metrics
+from .utils import routers
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+log = logging.getLogger(__name__)
+
+
+_entries = None
+
+
+def get_entries():
+    global _entries
+
+    if _entries is None:
+        _entries = LocalCache(settings.REPLICATED_QUERY_CACHE_SIZE)
+    return _entries
+
+
+def write_key(table):
+    return 'replicated:written:%s' % table
+
+
+def shared_cache():
+    from .dbchecker import cache
+
+    return cache
+
+
+def stamp(table):
+    timeout = settings.REPLICATED_QUERY_CACHE_TIMEOUT + settings.REPLICATED_QUERY_CACHE_SETTLE
+    shared_cache().set(write_key(table), time.time(), timeout)
+
+
+def mark_written(table, using=None):
+    '''
+    Invalidates cached results of queries reading the table, now and after
+    the current transaction on the ``using`` database commits.
+    '''
+    stamp(table)
+
+    # Rows read before a late commit are cached under the first stamp,
+    # the second one makes them stale.
+    on_commit = getattr(transaction, 'on_commit', None)  # django 1.9+
+    if using is not None and on_commit is not None and connections[using].in_atomic_block:
+        on_commit(partial(stamp, table), using=using)
+
+
+def invalidate_model(model, using=None):
+    mark_written(model._meta.db_table, using)
+
+
+def query_tables(query):
+    '''
+    Tables of a compiled query.
+    '''
+    return sorted(set(
+        table.table_name for table in query.alias_map.values()
+        if getattr(table, 'table_name', None)
+    ))
+
+
+def cached_queryset(queryset):
+    '''
+    Returns a list of queryset results, from the cache if possible.
+    '''
+    router = routers.router
+    if (
+        not settings.REPLICATED_QUERY_CACHE or
+        router.state() != 'slave' or
+        router.context.required_position is not None or
+        # Tables of prefetched objects are not tracked
+        queryset._prefetch_related_lookups
+    ):
+        return list(queryset)
+
+    alias = queryset.db
+    query = queryset.query.clone()
+    try:
+        sql, params = query.get_compiler(using=alias).as_sql()
+    except EmptyResultSet:
+        return list(queryset)
+    tables = query_tables(query)
+    cluster = router.alias_clusters.get(alias)
+
+    key = hashlib.md5(repr((
+        cluster.name if cluster is not None else alias, sql, tuple(params),
+    )).encode('utf-8')).hexdigest()
+
+    written = shared_cache().get_many([write_key(table) for table in tables])
+    tags = tuple(written.get(write_key(table)) for table in tables)
+
+    entries = get_entries()
+    entry = entries.get(key)
+    if entry is not None and entry[0] == tags:
+        if metrics.enabled:
+            metrics.incr('query_cache_hits')
+        return pickle.loads(entry[1])
+
+    if metrics.enabled:
+        metrics.incr('query_cache_misses')
+
+    result = list(queryset)
+
+    settled = time.time() - settings.REPLICATED_QUERY_CACHE_SETTLE
+    if all(tag is None or tag < settled for tag in tags):
+        entries.set(key, (tags, pickle.dumps(result, pickle.HIGHEST_PROTOCOL)),
+                    settings.REPLICATED_QUERY_CACHE_TIMEOUT)
+    else:
+        log.debug('Not caching query of recently written tables: %s', ', '.join(tables))
+
+    return result
+
+
+def on_model_change(sender, **kwargs):
+    invalidate_model(sender, kwargs.get('using'))
+
+
+def install_invalidation():
+    '''
+    Connects model signals invalidating cached results.
+    '''
+    from django.db.models import signals
+
+    for signal in (signals.post_save, signals.post_delete, signals.m2m_changed):
+        signal.connect(on_model_change, dispatch_uid='django_replicated.querycache')
@@ -2,48 +2,257 @@
 from __future__ import unicode_literals
 
 import logging
-import random
-from threading import local
+import time
+from itertools import islice
+
+from .balancer import install_query_timing, rendezvous_order
+from .metrics import metrics
+from .topology import DEFAULT_CLUSTER, build_clusters
+from .utils import ContextLocal
 
 log = logging.getLogger(__name__)
 
 
+class RoutingContext(object):
+    '''
+    Routing state of a single logical operation (e.g. a web request).
+    '''
+    def __init__(self):
+        self.state_stack = []
+        self.cluster_stack = []
+        self.chosen = {}
+        self.state_change_enabled = True
+        self.required_position = None
+        self.affinity_key = None
+        self.parent = None
+        # Started by 'init' and finished by 'reset'
+        self.managed = False
+        # Limiter slots taken by the operation
+        self.held = []
+        # Tables (or cluster names) written by the operation
+        self.written = set()
+
+    def child(self):
+        '''
+        Copy with own state stacks. Chosen databases are shared with
+        the parent, so the operation keeps using the same slave.
+        '''
+        context = RoutingContext()
+        context.state_stack = list(self.state_stack)
+        context.cluster_stack = list(self.cluster_stack)
+        context.chosen = self.chosen
+        context.state_change_enabled = self.state_change_enabled
+        context.required_position = self.required_position
+        context.affinity_key = self.affinity_key
+        context.managed = self.managed
+        context.held = self.held
+        context.written = self.written
+        context.parent = self
+        return context
+
+
 class ReplicationRouter(object):
 
     def __init__(self):
         from django.db import DEFAULT_DB_ALIAS
         from django.conf import settings
+        from django.core.exceptions import ImproperlyConfigured
 
-        self._context = local()
+        self._context = ContextLocal('django_replicated_context_%x' % id(self))
 
         self.DEFAULT_DB_ALIAS = DEFAULT_DB_ALIAS
         self.DOWNTIME = settings.REPLICATED_DATABASE_DOWNTIME
         self.SLAVES = settings.REPLICATED_DATABASE_SLAVES or [DEFAULT_DB_ALIAS]
         self.CHECK_STATE_ON_WRITE = settings.REPLICATED_CHECK_STATE_ON_WRITE
+        self.MAX_REPLICATION_LAG = settings.REPLICATED_MAX_REPLICATION_LAG
+        self.REPLICATION_LAG_CACHE_SECONDS = settings.REPLICATED_REPLICATION_LAG_CACHE_SECONDS
+        self.MASTER_DISCOVERY = settings.REPLICATED_MASTER_DISCOVERY
+        self.MASTER_DISCOVERY_SECONDS = settings.REPLICATED_MASTER_DISCOVERY_SECONDS
+        self.CHECK_FANOUT = settings.REPLICATED_CHECK_FANOUT if settings.REPLICATED_CHECK_TIMEOUT is not None else 1
+
+        self.STICKY_AFTER_WRITE = settings.REPLICATED_STICKY_AFTER_WRITE
+        if self.STICKY_AFTER_WRITE is True:
+            self.STICKY_AFTER_WRITE = 'models'
+        if self.STICKY_AFTER_WRITE not in (False, None, 'models', 'all'):
+            raise ImproperlyConfigured(
+                'REPLICATED_STICKY_AFTER_WRITE: unknown mode "%s"' % self.STICKY_AFTER_WRITE
+            )
+
+        self.POOLS = dict(settings.REPLICATED_SLAVE_POOLS)
+        self.MODEL_ROUTES = {}
+        for label, route in settings.REPLICATED_MODEL_ROUTES.items():
+            if isinstance(route, (list, tuple)):
+                self.POOLS[','.join(route)] = list(route)
+                route = ','.join(route)
+            elif route != 'master' and route not in self.POOLS:
+                raise ImproperlyConfigured(
+                    'REPLICATED_MODEL_ROUTES: unknown slave pool "%s" for "%s"' % (route, label)
+                )
+            self.MODEL_ROUTES[label.lower()] = route
+
+        self.clusters = build_clusters(settings, DEFAULT_DB_ALIAS)
+        self.default_cluster = self.clusters[DEFAULT_CLUSTER]
+        self.balancer = self.default_cluster.balancer
+
+        # Models bound to clusters by their configuration
+        self.MODEL_CLUSTERS = {}
+        for cluster in self.clusters.values():
+            for label in cluster.models:
+                self.MODEL_CLUSTERS[label] = cluster
+
+        self.all_allowed_aliases = []
+        self.alias_clusters = {}
+        for cluster in self.clusters.values():
+            for alias in cluster.aliases:
+                self.alias_clusters.setdefault(alias, cluster)
+                if alias not in self.all_allowed_aliases:
+                    self.all_allowed_aliases.append(alias)
+        for pool in self.POOLS.values():
+            for alias in pool:
+                self.alias_clusters.setdefault(alias, self.default_cluster)
+                if alias not in self.all_allowed_aliases:
+                    self.all_allowed_aliases.append(alias)
+
+        self._models = {}
+
+        if settings.REPLICATED_METRICS_SINKS:
+            metrics.configure(settings.REPLICATED_METRICS_SINKS)
+
+        if settings.REPLICATED_QUERY_TIMING:
+            install_query_timing(alias for alias in self.all_allowed_aliases if alias != DEFAULT_DB_ALIAS)
+
+        self.prober = None
+        if settings.REPLICATED_PROBE_INTERVAL:
+            from .prober import HealthProber
+
+            self.prober = HealthProber(
+                self.all_allowed_aliases,
+                settings.REPLICATED_PROBE_INTERVAL,
+                downtime=self.DOWNTIME,
+                lag_cache_seconds=self.REPLICATION_LAG_CACHE_SECONDS,
+                shared=settings.REPLICATED_PROBE_SHARED,
+            )
 
-        self.all_allowed_aliases = [self.DEFAULT_DB_ALIAS] + self.SLAVES
+        self.QUERY_CACHE = settings.REPLICATED_QUERY_CACHE
+        if self.QUERY_CACHE:
+            from .querycache import install_invalidation
+
+            install_invalidation()
+
+        self.limiter = None
+        if settings.REPLICATED_SLAVE_LIMITS:
+            from .limits import Limiter
+
+            limits = dict(settings.REPLICATED_SLAVE_LIMITS)
+            if settings.REPLICATED_MASTER_READ_BUDGET is not None:
+                for cluster in self.clusters.values():
+                    limits['master:%s' % cluster.master] = settings.REPLICATED_MASTER_READ_BUDGET
+
+            cache = None
+            if settings.REPLICATED_LIMITS_SHARED:
+                from .dbchecker import cache
+                cache = cache.shared
+
+            self.limiter = Limiter(limits, cache)
 
     def reset(self):
-        self._context.state_stack = []
-        self._context.chosen = {}
-        self._context.state_change_enabled = True
-        self._context.inited = True
+        context = self._context.get()
+        if context is not None and context.held:
+            for name in context.held:
+                self.limiter.release(name)
+            del context.held[:]
+
+        self._context.set(RoutingContext())
 
     @property
     def context(self):
-        if not getattr(self._context, 'inited', False):
-            self.reset()
-        return self._context
+        context = self._context.get()
+        if context is None:
+            context = RoutingContext()
+            self._context.set(context)
+        return context
+
+    def set_context(self, context):
+        '''
+        Makes the routing context current, e.g. one built in another thread.
+        '''
+        self._context.set(context)
 
-    def init(self, state):
+    def init(self, state, cluster=None):
         self.reset()
-        self.use_state(state)
+        self.context.managed = True
+        self.use_state(state, cluster)
+
+    def health(self, db_name):
+        '''
+        Database health from the background prober snapshot or None
+        if probing is disabled or the snapshot is not ready.
+        '''
+        if self.prober is None:
+            return None
+        return self.prober.health(db_name)
+
+    def is_alive(self, db_name, batch=None):
+        '''
+        Whether the database is alive by the background prober snapshot
+        or by a check, in the ``dbchecker.HealthBatch`` if it is given.
+        '''
+        health = self.health(db_name)
+        if health is not None:
+            return health.alive
+
+        if batch is not None:
+            return batch.check(db_name)
 
-    def is_alive(self, db_name):
         from .dbchecker import db_is_alive
 
         return db_is_alive(db_name, self.DOWNTIME)
 
+    def is_lagging(self, db_name):
+        '''
+        Whether replication lag of the database exceeds the configured
+        maximum. Databases with unknown lag are not considered lagging.
+        '''
+        if self.MAX_REPLICATION_LAG is None:
+            return False
+
+        health = self.health(db_name)
+        if health is not None:
+            lag = health.lag
+        else:
+            from .dbchecker import db_replication_lag
+
+            lag = db_replication_lag(db_name, self.REPLICATION_LAG_CACHE_SECONDS)
+        return lag is not None and lag > self.MAX_REPLICATION_LAG
+
+    def require_position(self, position):
+        '''
+        Makes reads in slave state use only slaves that have replayed
+        the master replication position (see ``dbchecker.replication_position``),
+        or master if there are no such slaves.
+        '''
+        self.context.required_position = position
+        self.context.chosen = dict(
+            (key, alias) for key, alias in self.context.chosen.items()
+            if not key[1].startswith('slave')
+        )
+
+    def set_affinity(self, key):
+        '''
+        Makes reads in slave state prefer the same slave for the same key
+        (e.g. a client id) using rendezvous hashing instead of the balancer.
+        '''
+        self.context.affinity_key = key
+        self.context.chosen = dict(
+            (key, alias) for key, alias in self.context.chosen.items()
+            if not key[1].startswith('slave')
+        )
+
+    def has_replayed(self, db_name, position):
+        from .dbchecker import check_replayed
+
+        return check_replayed(db_name, position)
+
     def set_state_change(self, enabled):
         self.context.state_change_enabled = enabled
 
@@ -56,14 +265,30 @@ class ReplicationRouter(object):
         else:
             return 'master'
 
-    def use_state(self, state):
+    def cluster(self):
+        '''
+        Name of the current cluster.
         '''
-        Switches router into a new state. Requires a paired call
+        if self.context.cluster_stack:
+            return self.context.cluster_stack[-1]
+        else:
+            return DEFAULT_CLUSTER
+
+    def use_state(self, state, cluster=None):
+        '''
+        Switches router into a new state and optionally into another cluster
+        (by default the current one is kept). Requires a paired call
         to 'revert' for reverting to previous state.
         '''
+        if cluster is None:
+            cluster = self.cluster()
+        elif cluster not in self.clusters:
+            raise ValueError('Unknown cluster "%s"' % cluster)
+
         if not self.context.state_change_enabled:
             state = self.state()
         self.context.state_stack.append(state)
+        self.context.cluster_stack.append(cluster)
         return self
 
     def revert(self):
@@ -72,41 +297,325 @@ class ReplicationRouter(object):
         'use_state'.
         '''
         self.context.state_stack.pop()
+        self.context.cluster_stack.pop()
+
+    def enter_state(self, state, cluster=None):
+        '''
+        Like 'use_state', but switches to a child routing context first,
+        so that coroutines started before do not see the new state even
+        if they share the context with the caller. Requires a paired call
+        to 'exit_state'.
+        '''
+        self._context.set(self.context.child())
+        return self.use_state(state, cluster)
+
+    def exit_state(self):
+        '''
+        Returns to the routing context active before 'enter_state'.
+        '''
+        parent = self.context.parent
+        # The context could have been reset inside, e.g. by middleware.
+        if parent is not None:
+            self._context.set(parent)
+
+    def model_info(self, model):
+        '''
+        Returns a tuple of the cluster the model is bound to (or None) and
+        its read route from ``REPLICATED_MODEL_ROUTES``: 'master', a slave
+        pool name or None for cluster slaves. Both are looked up by
+        "app_label.model_name" and then by "app_label", once per model.
+        '''
+        try:
+            return self._models[model]
+        except KeyError:
+            pass
+
+        opts = model._meta
+        app_label = opts.app_label.lower()
+        labels = ('%s.%s' % (app_label, opts.model_name), app_label)
+
+        cluster = route = None
+        for label in labels:
+            cluster = cluster or self.MODEL_CLUSTERS.get(label)
+            route = route or self.MODEL_ROUTES.get(label)
+
+        self._models[model] = cluster, route
+        return cluster, route
+
+    def route_for_model(self, model):
+        if model is None or not (self.MODEL_ROUTES or self.MODEL_CLUSTERS):
+            return None, None
+        return self.model_info(model)
+
+    def master_for(self, model=None):
+        cluster, _ = self.route_for_model(model)
+        if cluster is None:
+            cluster = self.clusters[self.cluster()]
 
-    def db_for_write(self, *args, **kwargs):
+        return self.master_of(cluster)
+
+    def master_of(self, cluster):
+        '''
+        Current master of the cluster. It is found once per operation started
+        by ``init``; other contexts (e.g. in Celery tasks) live as long as
+        their thread, so there it is found again after
+        ``REPLICATED_MASTER_DISCOVERY_SECONDS``.
+        '''
+        if not self.MASTER_DISCOVERY:
+            return cluster.master
+
+        context = self.context
+        key = cluster.name, 'master'
+        found = context.chosen.get(key)
+        if found is not None and (found[1] is None or found[1] > time.time()):
+            return found[0]
+
+        master = self.current_master(cluster)
+        expires = None if context.managed else time.time() + self.MASTER_DISCOVERY_SECONDS
+        context.chosen[key] = master, expires
+        return master
+
+    def current_master(self, cluster):
+        '''
+        The configured master of the cluster or, with
+        ``REPLICATED_MASTER_DISCOVERY``, the first writable database of the
+        cluster, starting with the configured master.
+        '''
+        if not self.MASTER_DISCOVERY:
+            return cluster.master
+
+        if self.prober is not None and self.prober.current() is not None:
+            for alias in cluster.aliases:
+                health = self.health(alias)
+                if health is not None and health.alive and health.writable:
+                    return alias
+            return cluster.master
+
+        from .dbchecker import check_master
+
+        return check_master(cluster.name, cluster.aliases, self.MASTER_DISCOVERY_SECONDS, self.DOWNTIME)
+
+    def db_for_write(self, model=None, **hints):
         if self.CHECK_STATE_ON_WRITE and self.state() != 'master':
             raise RuntimeError('Trying to access master database in slave state')
 
-        self.context.chosen['master'] = self.DEFAULT_DB_ALIAS
+        master = self.master_for(model)
+        if metrics.enabled:
+            metrics.incr('writes', alias=master)
+
+        if self.QUERY_CACHE and model is not None:
+            from .querycache import invalidate_model
 
-        log.debug('db_for_write: %s', self.DEFAULT_DB_ALIAS)
-        return self.DEFAULT_DB_ALIAS
+            invalidate_model(model, master)
+
+        if self.STICKY_AFTER_WRITE:
+            self.mark_written(model)
+
+        log.debug('db_for_write: %s', master)
+        return master
+
+    def db_for_read(self, model=None, **hints):
+        chosen = self.read_alias(model)
+        if metrics.enabled:
+            metrics.incr('reads', alias=chosen)
+        return chosen
 
-    def db_for_read(self, *args, **kwargs):
+    def mark_written(self, model=None):
+        '''
+        Remembers a write in the routing context, so that following reads
+        of the model (or of its cluster in 'all' mode) go to master.
+        '''
+        if self.STICKY_AFTER_WRITE == 'all':
+            cluster, _ = self.route_for_model(model)
+            self.context.written.add((cluster or self.clusters[self.cluster()]).name)
+        elif model is not None:
+            self.context.written.add(model._meta.db_table)
+
+    def reads_written(self, model=None):
+        written = self.context.written
+        if not written:
+            return False
+        if self.STICKY_AFTER_WRITE == 'all':
+            cluster, _ = self.route_for_model(model)
+            return (cluster or self.clusters[self.cluster()]).name in written
+        return model is not None and model._meta.db_table in written
+
+    def read_alias(self, model=None):
         if self.state() == 'master':
-            return self.db_for_write(*args, **kwargs)
+            return self.master_for(model)
 
-        if self.state() in self.context.chosen:
-            return self.context.chosen[self.state()]
+        if self.reads_written(model):
+            master = self.master_for(model)
+            log.debug('db_for_read: %s (written in this context)', master)
+            return master
 
-        slaves = self.SLAVES[:]
-        random.shuffle(slaves)
+        cluster, key, slaves = self.read_target(model)
+        if key is None:
+            master = self.master_of(cluster)
+            log.debug('db_for_read: %s (model route)', master)
+            return master
 
-        for slave in slaves:
-            if self.is_alive(slave):
-                chosen = slave
-                break
-        else:
-            chosen = self.DEFAULT_DB_ALIAS
+        if key in self.context.chosen:
+            return self.context.chosen[key]
 
-        self.context.chosen[self.state()] = chosen
+        chosen = self.choose_slave(cluster, slaves)
+        self.context.chosen[key] = chosen
 
         log.debug('db_for_read: %s', chosen)
         return chosen
 
+    def read_target(self, model=None):
+        '''
+        Returns the cluster for reads of the model, the key of the chosen
+        slave in the routing context and candidate slaves. The key is None
+        if the model is routed to the master.
+        '''
+        cluster, route = self.route_for_model(model)
+        if cluster is None:
+            cluster = self.clusters[self.cluster()]
+
+        if route == 'master':
+            return cluster, None, None
+
+        if route is None:
+            key, slaves = (cluster.name, self.state()), cluster.slaves
+        else:
+            key, slaves = (cluster.name, '%s:%s' % (self.state(), route)), self.POOLS[route]
+
+        if self.MASTER_DISCOVERY:
+            slaves = self.replicas_around(cluster, slaves, pool=route is not None)
+        return cluster, key, slaves
+
+    def replicas_around(self, cluster, slaves, pool=False):
+        '''
+        Slaves after a failover: without the promoted one and, unless they
+        are a pool, with the configured master, which is probably a replica
+        now (if it is dead, health checks skip it).
+        '''
+        master = self.master_of(cluster)
+        if master == cluster.master:
+            return slaves
+
+        slaves = [alias for alias in slaves if alias != master]
+        if not pool:
+            slaves.append(cluster.master)
+        return slaves
+
+    def read_candidates(self, model=None, limit=2):
+        '''
+        Returns up to ``limit`` aliases suitable for reads of the model,
+        best first, without choosing one for the routing context.
+        '''
+        if self.state() == 'master' or self.reads_written(model):
+            return [self.master_for(model)]
+
+        cluster, key, slaves = self.read_target(model)
+        if key is None:
+            return [self.master_of(cluster)]
+
+        candidates = list(islice(self.suitable_slaves(cluster, slaves), limit))
+        return candidates or [self.master_of(cluster)]
+
+    def choose_slave(self, cluster, slaves):
+        '''
+        Returns the first suitable slave in the cluster balancer order
+        or the cluster master if there are none.
+        '''
+        if self.limiter is not None:
+            return self.choose_unsaturated_slave(cluster, slaves)
+
+        for slave in self.suitable_slaves(cluster, slaves):
+            return slave
+
+        if metrics.enabled:
+            metrics.incr('fallbacks_to_master', cluster=cluster.name)
+        return self.master_of(cluster)
+
+    def choose_unsaturated_slave(self, cluster, slaves):
+        '''
+        Like 'choose_slave', but skips slaves saturated according to
+        ``REPLICATED_SLAVE_LIMITS``, then spills to the master within
+        ``REPLICATED_MASTER_READ_BUDGET``, then uses the best slave anyway.
+        '''
+        best = None
+        for slave in self.suitable_slaves(cluster, slaves):
+            if self.acquire(slave):
+                return slave
+            log.debug('slave %s is saturated', slave)
+            best = best or slave
+
+        if best is None:
+            if metrics.enabled:
+                metrics.incr('fallbacks_to_master', cluster=cluster.name)
+            return self.master_of(cluster)
+
+        budget = 'master:%s' % cluster.master
+        if budget in self.limiter and self.acquire(budget):
+            if metrics.enabled:
+                metrics.incr('spills_to_master', cluster=cluster.name)
+            return self.master_of(cluster)
+
+        if metrics.enabled:
+            metrics.incr('saturated', cluster=cluster.name)
+        return best
+
+    def acquire(self, name):
+        '''
+        Takes a limiter slot. Operations started with 'init' hold
+        it until 'reset'.
+        '''
+        track = self.context.managed
+        if not self.limiter.acquire(name, track):
+            return False
+        if track and name in self.limiter:
+            self.context.held.append(name)
+        return True
+
+    def suitable_slaves(self, cluster, slaves):
+        '''
+        Yields alive, not lagging slaves that have replayed the required
+        position in the order of preference.
+        '''
+        batch = None
+        if self.prober is None or self.prober.current() is None:
+            from .dbchecker import HealthBatch, is_alive
+
+            batch = HealthBatch(is_alive, slaves, self.DOWNTIME)
+
+        position = self.context.required_position
+
+        if self.context.affinity_key is not None:
+            ordered = rendezvous_order(self.context.affinity_key, slaves,
+                                       getattr(cluster.balancer, 'weights', None))
+        else:
+            ordered = list(cluster.balancer.order(slaves))
+
+        for index, slave in enumerate(ordered):
+            if batch is not None and self.CHECK_FANOUT > 1:
+                # Check next slaves in parallel while waiting for this one
+                batch.start(ordered[index:index + self.CHECK_FANOUT])
+
+            if (
+                self.is_alive(slave, batch) and
+                not self.is_lagging(slave) and
+                (position is None or self.has_replayed(slave, position))
+            ):
+                if batch is not None:
+                    batch.flush()
+                yield slave
+
+        if batch is not None:
+            batch.flush()
+
     def allow_relation(self, obj1, obj2, **hints):
+        '''
+        Allows relations between objects from databases of the same cluster.
+        '''
+        clusters = set()
         for db in (obj1._state.db, obj2._state.db):
-            if db is not None and db not in self.all_allowed_aliases:
-                return False
+            if db is not None:
+                if db not in self.alias_clusters:
+                    return False
+                clusters.add(self.alias_clusters[db])
 
-        return True
+        return len(clusters) <= 1
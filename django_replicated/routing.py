@@ -0,0 +1,86 @@
+# coding: utf-8
+'''
+Routing state for code running outside of HTTP requests: Celery tasks,
+management commands, batch jobs.
+
+Usage:
+
+    from django_replicated import use_master, use_slave
+
+    with use_slave():
+        # reads go to slaves
+        with use_master():
+            # everything goes to master
+            ...
+
+    @use_slave
+    def build_report():
+        ...
+
+    @use_slave(cluster='users')
+    async def export_users():
+        ...
+
+States nest, are reverted on exceptions and are local to the current
+thread and coroutine. Unlike ``django_replicated.decorators`` these do not
+need a request.
+'''
+from __future__ import unicode_literals
+
+import functools
+import inspect
+
+import six
+
+
+class use_state(object):
+    '''
+    Context manager and decorator switching the router into the state
+    (and optionally the cluster) for the duration of a block or a call.
+    '''
+    def __init__(self, state, cluster=None):
+        if state not in ('master', 'slave'):
+            raise ValueError('Unknown state "%s"' % state)
+        self.state = state
+        self.cluster = cluster
+
+    def __enter__(self):
+        from .utils import routers
+
+        routers.router.enter_state(self.state, self.cluster)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        from .utils import routers
+
+        routers.router.exit_state()
+
+    def __call__(self, func):
+        if six.PY3 and inspect.iscoroutinefunction(func):
+            from .aio import wrap_coroutine
+
+            return wrap_coroutine(self, func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+
+        return wrapper
+
+
+def use_master(func=None, cluster=None):
+    '''
+    ``use_state('master')``, also usable as a decorator without arguments.
+    '''
+    if func is not None:
+        return use_state('master', cluster)(func)
+    return use_state('master', cluster)
+
+
+def use_slave(func=None, cluster=None):
+    '''
+    ``use_state('slave')``, also usable as a decorator without arguments.
+    '''
+    if func is not None:
+        return use_state('slave', cluster)(func)
+    return use_state('slave', cluster)
@@ -1,12 +1,134 @@
 # Cache backend name to store database state
 REPLICATED_CACHE_BACKEND = None
 
+# Time in seconds to keep database state from the cache backend in process
+# memory to avoid a cache backend request per database per request.
+# 0 disables the in-process cache
+REPLICATED_LOCAL_CACHE_SECONDS = 0
+
+# Maximum number of entries in the in-process cache
+REPLICATED_LOCAL_CACHE_SIZE = 1024
+
 # Timeout for dead databases alive check
 REPLICATED_DATABASE_DOWNTIME = 60
 
+# Deadline in seconds for a database check, including all tries. Checks
+# then run in a pool of REPLICATED_CHECK_WORKERS threads (requires
+# concurrent.futures, "futures" package on Python 2), a check that has not
+# finished in time fails, and REPLICATED_CHECK_FANOUT slaves are checked
+# in parallel when choosing one
+REPLICATED_CHECK_TIMEOUT = None
+REPLICATED_CHECK_WORKERS = 8
+REPLICATED_CHECK_FANOUT = 2
+
+# Use circuit breakers instead of plain dead marks for database checks.
+# After REPLICATED_CIRCUIT_BREAKER_THRESHOLD failed checks in a row a database
+# is considered dead for REPLICATED_DATABASE_DOWNTIME, then only one process
+# checks it, and each next failure doubles the downtime up to
+# REPLICATED_CIRCUIT_BREAKER_MAX_DOWNTIME
+REPLICATED_CIRCUIT_BREAKER = False
+REPLICATED_CIRCUIT_BREAKER_THRESHOLD = 1
+REPLICATED_CIRCUIT_BREAKER_MAX_DOWNTIME = 600
+
 # List of slave database aliases. Default database is always master
 REPLICATED_DATABASE_SLAVES = []
 
+# Route writes to the first writable database of a cluster (its master
+# first) instead of always its master, to follow failovers. Slaves are the
+# other databases of the cluster then. The choice is cached for
+# REPLICATED_MASTER_DISCOVERY_SECONDS
+REPLICATED_MASTER_DISCOVERY = False
+REPLICATED_MASTER_DISCOVERY_SECONDS = 5
+
+# Load limits of slaves: {alias: {'concurrency': N, 'rate': N}}, where
+# concurrency is a number of requests using the slave at the same time and
+# rate is a number of requests starting to use it per second. Reads of
+# a saturated slave go to the next one, then to master within
+# REPLICATED_MASTER_READ_BUDGET (same format, None disables spilling to
+# master, {} is unlimited), then to the best slave anyway
+REPLICATED_SLAVE_LIMITS = {}
+REPLICATED_MASTER_READ_BUDGET = None
+
+# Count load limits for all processes in the cache backend instead of
+# every process separately
+REPLICATED_LIMITS_SHARED = False
+
+# Additional clusters, each with its own master and slaves:
+# {'name': {'master': alias, 'slaves': [aliases], 'weights': {alias: weight},
+#           'selection': strategy, 'models': ['app_label', 'app_label.ModelName']}}
+# The default cluster is made of the default database and
+# REPLICATED_DATABASE_SLAVES
+REPLICATED_CLUSTERS = {}
+
+# Named groups of slave aliases for routing reads of particular models,
+# e.g. {'analytics': ['slave3', 'slave4']}
+REPLICATED_SLAVE_POOLS = {}
+
+# Routes for reads of models in slave state, by "app_label.ModelName" or
+# "app_label": 'master', a name of a slave pool or a list of slave aliases,
+# e.g. {'reports': 'analytics', 'counters.Counter': 'master'}
+REPLICATED_MODEL_ROUTES = {}
+
+# Replica selection strategy: 'random', 'p2c' (power of two choices),
+# 'least_latency' or an import path of a balancer class
+REPLICATED_SLAVE_SELECTION = 'random'
+
+# Static weights of slave aliases, e.g. {'slave1': 2, 'slave2': 1}.
+# Missing aliases have weight 1, zero weight excludes an alias
+REPLICATED_SLAVE_WEIGHTS = {}
+
+# Collect latency of every query on slaves for replica selection
+# (Django 2.0+), not only latency of health checks
+REPLICATED_QUERY_TIMING = False
+
+# Maximum replication lag in seconds for a slave to be used for reads.
+# Slaves lagging more are skipped, master is used if all slaves lag.
+# None disables lag checks
+REPLICATED_MAX_REPLICATION_LAG = None
+
+# Timeout for caching measured replication lag
+REPLICATED_REPLICATION_LAG_CACHE_SECONDS = 5
+
+# Interval in seconds for checking databases in a background thread.
+# The router uses results of these checks instead of checking databases
+# while handling requests. None disables background checks
+REPLICATED_PROBE_INTERVAL = None
+
+# Check databases in only one process per host and share results
+# with other processes through the cache backend
+REPLICATED_PROBE_SHARED = False
+
+# Send reads of the same client to the same slave while it is alive, which
+# keeps its working set warm in that slave's buffer cache. Client is
+# identified by "session" (session cookie), "user" (authenticated user id)
+# or a callable (or its import path) taking the request and returning a key
+REPLICATED_AFFINITY = None
+
+# Hedged reads (see django_replicated.hedging): percentile of recent read
+# durations after which a read is duplicated to the second best slave,
+# delay in seconds used until enough reads are timed, and thread pool size
+REPLICATED_HEDGE_PERCENTILE = 95
+REPLICATED_HEDGE_DELAY = 0.05
+REPLICATED_HEDGE_WORKERS = 8
+
+# Check databases, connect to them and run REPLICATED_WARMUP_QUERIES
+# at process start (see django_replicated.warmup). Requires
+# 'django_replicated' in INSTALLED_APPS
+REPLICATED_WARMUP = False
+REPLICATED_WARMUP_QUERIES = []
+
+# Cache results of querysets evaluated with
+# django_replicated.querycache.cached_queryset in slave state in process
+# memory for REPLICATED_QUERY_CACHE_TIMEOUT seconds, at most
+# REPLICATED_QUERY_CACHE_SIZE results. Writes to tables invalidate results
+# of queries reading them, tables written less than
+# REPLICATED_QUERY_CACHE_SETTLE seconds ago (longer than the replication
+# lag) are not cached
+REPLICATED_QUERY_CACHE = False
+REPLICATED_QUERY_CACHE_TIMEOUT = 60
+REPLICATED_QUERY_CACHE_SIZE = 1000
+REPLICATED_QUERY_CACHE_SETTLE = 5
+
 # View name to state mapping
 REPLICATED_VIEWS_OVERRIDES = {}
 
@@ -22,14 +144,32 @@ REPLICATED_FORCE_MASTER_COOKIE_NAME = 'just_updated'
 # Cookie life time in seconds
 REPLICATED_FORCE_MASTER_COOKIE_MAX_AGE = 5
 
+# Store master replication position (MySQL GTID, PostgreSQL LSN) in the
+# read-after-write cookie instead of forcing master on the next request.
+# Reads then use slaves that have replayed that position, or master
+REPLICATED_READ_YOUR_WRITES = False
+
 # Header name for forcing state switch
 REPLICATED_FORCE_STATE_HEADER = 'HTTP_X_REPLICATED_STATE'
 
 # Enable or disable state checking on writes
 REPLICATED_CHECK_STATE_ON_WRITE = True
 
+# Reads after a write in the same routing context (request) go to master:
+# reads of written models with True or 'models', all reads of the written
+# cluster with 'all'. Useful with REPLICATED_CHECK_STATE_ON_WRITE = False
+REPLICATED_STICKY_AFTER_WRITE = False
+
 # Status codes on which set cookie for read-after-write workaround
 REPLICATED_FORCE_MASTER_COOKIE_STATUS_CODES = (302, 303)
 
 
+# Metrics sinks: import paths of sink classes or instances, or callables
+# (see django_replicated.metrics), e.g.
+# ['django_replicated.metrics.InMemorySink']
+REPLICATED_METRICS_SINKS = []
+
+
+# With ATOMIC_REQUESTS, wrap requests in a transaction only on the database
+# they read from
 REPLICATED_MANAGE_ATOMIC_REQUESTS = False
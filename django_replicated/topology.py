@@ -0,0 +1,79 @@
+# coding: utf-8
+'''
+Replication topology: named clusters, each with its own master and slaves.
+
+The default cluster is built from ``DEFAULT_DB_ALIAS`` and
+``REPLICATED_DATABASE_SLAVES``. Additional clusters are configured with
+``REPLICATED_CLUSTERS``:
+
+    REPLICATED_CLUSTERS = {
+        'users': {
+            'master': 'users',
+            'slaves': ['users_slave1', 'users_slave2'],
+            'weights': {'users_slave1': 2},
+            'models': ['accounts', 'profiles.Avatar'],
+        },
+    }
+
+Models listed in a cluster are always routed to it, others are routed to
+the cluster chosen for the routing state (see ``ReplicationRouter.use_state``).
+'''
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .balancer import get_balancer
+
+
+DEFAULT_CLUSTER = 'default'
+
+
+class Cluster(object):
+    def __init__(self, name, master, slaves=None, weights=None, selection='random', models=()):
+        self.name = name
+        self.master = master
+        self.slaves = list(slaves or []) or [master]
+        self.models = [label.lower() for label in models]
+        self.balancer = get_balancer(selection, weights)
+
+        self.aliases = [master] + [alias for alias in self.slaves if alias != master]
+        self.allowed = frozenset(self.aliases)
+
+    def __repr__(self):
+        return '<Cluster %s: %s -> %s>' % (self.name, self.master, ', '.join(self.slaves))
+
+
+def build_clusters(settings, default_alias):
+    '''
+    Returns an ordered dict of clusters by name, the default one first.
+    '''
+    clusters = OrderedDict()
+    clusters[DEFAULT_CLUSTER] = Cluster(
+        DEFAULT_CLUSTER,
+        default_alias,
+        settings.REPLICATED_DATABASE_SLAVES,
+        weights=settings.REPLICATED_SLAVE_WEIGHTS,
+        selection=settings.REPLICATED_SLAVE_SELECTION,
+    )
+
+    for name in sorted(settings.REPLICATED_CLUSTERS):
+        config = settings.REPLICATED_CLUSTERS[name]
+        if name == DEFAULT_CLUSTER:
+            raise ImproperlyConfigured(
+                'REPLICATED_CLUSTERS: "%s" is reserved for the default cluster' % name
+            )
+        if 'master' not in config:
+            raise ImproperlyConfigured('REPLICATED_CLUSTERS: no master for cluster "%s"' % name)
+
+        clusters[name] = Cluster(
+            name,
+            config['master'],
+            config.get('slaves'),
+            weights=config.get('weights'),
+            selection=config.get('selection', settings.REPLICATED_SLAVE_SELECTION),
+            models=config.get('models', ()),
+        )
+
+    return clusters
@@ -1,7 +1,25 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
+import threading
+
 from django import db
+from django.core.exceptions import ImproperlyConfigured
+
+try:  # django 1.8+
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
+
+try:  # python 3.7+
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
+
+try:
+    from concurrent import futures
+except ImportError:  # python 2 without the "futures" backport
+    futures = None
 
 
 def get_object_name(obj):
@@ -11,8 +29,90 @@ def get_object_name(obj):
         return obj.__class__.__name__
 
 
+class ContextLocal(object):
+    '''
+    Holds a value local to the current execution context: an asyncio task
+    or a thread. Falls back to a thread local value on pythons without
+    ``contextvars``.
+    '''
+    def __init__(self, name):
+        if ContextVar is not None:
+            self._var = ContextVar(name, default=None)
+        else:
+            self._var = None
+            self._local = threading.local()
+
+    def get(self):
+        if self._var is not None:
+            return self._var.get()
+        return getattr(self._local, 'value', None)
+
+    def set(self, value):
+        if self._var is not None:
+            self._var.set(value)
+        else:
+            self._local.value = value
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(name, workers):
+    '''
+    Returns a thread pool shared by all callers with the same name.
+    '''
+    executor = _executors.get(name)
+    if executor is None:
+        if futures is None:
+            raise ImproperlyConfigured('%s require concurrent.futures ("futures" package on Python 2)' % name)
+        with _executors_lock:
+            executor = _executors.get(name)
+            if executor is None:
+                executor = _executors[name] = futures.ThreadPoolExecutor(workers)
+    return executor
+
+
+def find_replication_router():
+    '''
+    Returns the ``ReplicationRouter`` instance from ``DATABASE_ROUTERS``.
+    '''
+    from .router import ReplicationRouter
+
+    for r in db.router.routers:
+        if isinstance(r, ReplicationRouter):
+            return r
+
+    raise ImproperlyConfigured(
+        'django_replicated.router.ReplicationRouter (or its subclass) '
+        'is not found in DATABASE_ROUTERS'
+    )
+
+
 class Routers(object):
+    '''
+    Proxy to the replication router. The router is located once and
+    relocated only when ``DATABASE_ROUTERS`` setting changes. Attributes
+    missing in the replication router are looked up in other routers.
+    '''
+    _router = None
+
+    @property
+    def router(self):
+        router = self._router
+        if router is None:
+            router = self._router = find_replication_router()
+        return router
+
+    def invalidate(self):
+        self._router = None
+
     def __getattr__(self, name):
+        try:
+            return getattr(self.router, name)
+        except (AttributeError, ImproperlyConfigured):
+            pass
+
         for r in db.router.routers:
             if hasattr(r, name):
                 return getattr(r, name)
@@ -21,3 +121,11 @@ class Routers(object):
 
 
 routers = Routers()
+
+
+def reset_routers(**kwargs):
+    if kwargs['setting'] == 'DATABASE_ROUTERS':
+        routers.invalidate()
+
+
+setting_changed.connect(reset_routers, dispatch_uid='django_replicated.utils.reset_routers')
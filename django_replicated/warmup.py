@@ -0,0 +1,93 @@
+# coding: utf-8
+'''
+Warming up a worker process before it gets requests.
+
+``warmup()`` checks all databases known to the router in parallel, which
+puts their state into the health cache (or the background prober snapshot)
+and replica statistics, then opens connections to alive databases in the
+calling thread and runs warm-up queries (``REPLICATED_WARMUP_QUERIES``)
+on them.
+
+Connections opened in the calling thread are only reused by requests
+handled in the same thread and with persistent connections (``CONN_MAX_AGE``).
+Call it after forking worker processes, e.g. from gunicorn ``post_fork``
+hook, never in a parent process whose connections would be inherited by
+children. With ``REPLICATED_WARMUP = True`` it is called from
+``AppConfig.ready`` (requires "django_replicated" in ``INSTALLED_APPS``).
+'''
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from . import dbchecker
+from .utils import routers
+
+
+log = logging.getLogger(__name__)
+
+
+def probe(router, alias, results):
+    try:
+        if router.prober is not None:
+            results[alias] = router.prober.probe_one(alias)
+            return
+
+        alive = dbchecker.check_db(dbchecker.is_alive, alias, router.DOWNTIME, force=True)
+        if alive and router.MAX_REPLICATION_LAG is not None:
+            dbchecker.check_replication_lag(alias, router.REPLICATION_LAG_CACHE_SECONDS, force=True)
+        results[alias] = alive
+    finally:
+        # Connections of this short-lived thread would never be reused.
+        connections[alias].close()
+
+
+def warmup(aliases=None, queries=None):
+    '''
+    Checks databases in parallel, connects to alive ones and runs warm-up
+    queries on them. Returns a dict of alias -> alive.
+    '''
+    router = routers.router
+    if aliases is None:
+        aliases = router.all_allowed_aliases
+    if queries is None:
+        queries = settings.REPLICATED_WARMUP_QUERIES
+
+    if router.prober is not None:
+        router.prober.ensure_running()
+
+    results = {}
+    threads = [
+        threading.Thread(target=probe, args=(router, alias, results), name='warmup-%s' % alias)
+        for alias in aliases
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if router.prober is not None:
+        # Background probing has just started, give it a ready snapshot.
+        router.prober.publish(dict(results), time.time())
+        results = dict((alias, health.alive) for alias, health in results.items())
+
+    for alias in aliases:
+        if not results.get(alias):
+            log.warning('Database "%s" is not available during warm-up', alias)
+            continue
+
+        connection = connections[alias]
+        try:
+            connection.ensure_connection()
+            if queries:
+                with connection.cursor() as cursor:
+                    for query in queries:
+                        cursor.execute(query)
+        except Exception as e:
+            log.warning('Warm-up of database "%s" failed: %s', alias, e)
+
+    return results
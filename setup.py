@@ -6,6 +6,8 @@ setup(
     description='Django DB router for stateful master-slave replication',
     packages=[
         'django_replicated',
+        'django_replicated.management',
+        'django_replicated.management.commands',
     ],
     classifiers=[
         'Development Status :: 5 - Production/Stable',
@@ -9,8 +9,9 @@ from django.db import transaction
 
 
 def set_non_atomic_attributes(response, view):
-    response['Default-Non-Atomic'] = ','.join(sorted(getattr(view, '_replicated_view_default_non_atomic_dbs', [])))
-    response['Non-Atomic'] = ','.join(sorted(getattr(view, '_non_atomic_requests', [])))
+    non_atomic = getattr(view, '_non_atomic_requests', [])
+    response['Default-Non-Atomic'] = ','.join(sorted(getattr(non_atomic, 'declared', [])))
+    response['Non-Atomic'] = ','.join(sorted(non_atomic))
 
 
 def get_response():
@@ -57,6 +58,7 @@ instance_view = TestInstanceMethod()
 def non_atomic_view(request):
     response = HttpResponse()
     response['DB-Used'] = routers.db_for_read()
+    set_non_atomic_attributes(response, non_atomic_view)
     return response
 
 
@@ -1,6 +1,8 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
+import sys
+
 import pytest
 from django.conf import settings
 
@@ -8,6 +10,25 @@ from django_replicated import settings as replicated_settings
 
 pytestmark = pytest.mark.django_db
 
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore.append('test_aio.py')
+
+
+class FakeClock(object):
+    '''
+    Replaces ``time.time`` for code taking a clock, advanced by changing ``now``.
+    '''
+    now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
 
 def pytest_configure():
     test_settings = replicated_settings.__dict__.copy()
@@ -0,0 +1,134 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import asyncio
+import sys
+
+import pytest
+from mock import MagicMock, patch
+
+from django.http import HttpResponse
+from django.test import RequestFactory
+
+from django_replicated import aio
+from django_replicated.middleware import ReplicationMiddleware
+from django_replicated.utils import routers
+
+
+pytestmark = pytest.mark.django_db
+
+# Routing state falls back to thread locals without contextvars
+requires_contextvars = pytest.mark.skipif(sys.version_info < (3, 7), reason='requires contextvars')
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+@requires_contextvars
+def test_routing_state_per_task():
+    async def handle(state):
+        routers.init(state)
+        await asyncio.sleep(0)
+        state = routers.state()
+        routers.reset()
+        return state
+
+    async def main():
+        return await asyncio.gather(handle('master'), handle('slave'), handle('master'))
+
+    assert run(main()) == ['master', 'slave', 'master']
+
+
+def test_async_middleware():
+    async def view(request):
+        response = HttpResponse()
+        response['Router-Used'] = routers.state()
+        return response
+
+    middleware = ReplicationMiddleware(view)
+    # Without blocking hooks there is no switch to a thread
+    with patch('django_replicated.aio.in_sync_thread') as in_sync_thread_mock:
+        response = run(middleware.__acall__(RequestFactory().get('/')))
+
+        in_sync_thread_mock.assert_not_called()
+
+    assert response['Router-Used'] == 'slave'
+    assert routers.state() == 'master'
+
+
+def test_async_middleware_database_access(settings):
+    pytest.importorskip('asgiref')
+
+    from django.db import connections
+
+    def get_affinity_key(request):
+        # e.g. a session loaded from the database
+        with connections['default'].cursor() as cursor:
+            cursor.execute('SELECT 1')
+        return 'client'
+
+    async def view(request):
+        response = HttpResponse()
+        response['Affinity'] = routers.router.context.affinity_key
+        return response
+
+    settings.REPLICATED_AFFINITY = get_affinity_key
+    middleware = ReplicationMiddleware(view)
+    response = run(middleware.__acall__(RequestFactory().get('/')))
+
+    # The routing context built in the thread is used by the view
+    assert response['Affinity'] == 'client'
+
+
+def test_async_middleware_position_cookie(settings):
+    pytest.importorskip('asgiref')
+
+    from django.http import HttpResponseRedirect
+    from django_replicated.middleware import encode_position
+
+    async def view(request):
+        return HttpResponseRedirect('/')
+
+    settings.REPLICATED_READ_YOUR_WRITES = True
+    middleware = ReplicationMiddleware(view)
+    with patch('django_replicated.dbchecker.replication_position', return_value='0/3000060'):
+        response = run(middleware.__acall__(RequestFactory().post('/')))
+
+    cookie = response.cookies[settings.REPLICATED_FORCE_MASTER_COOKIE_NAME].value
+    assert cookie == encode_position('0/3000060')
+
+
+def test_async_check_db():
+    pytest.importorskip('asgiref')
+
+    checker = MagicMock(return_value=True)
+
+    assert run(aio.check_db(checker, 'default')) is True
+    assert checker.call_count == 1
+
+
+@requires_contextvars
+def test_use_state_coroutines():
+    from django_replicated import use_master, use_slave
+
+    @use_slave
+    async def decorated():
+        await asyncio.sleep(0)
+        return routers.state()
+
+    async def child(state, wait):
+        with (use_master() if state == 'master' else use_slave()):
+            await asyncio.sleep(wait)
+            return routers.state()
+
+    async def parent():
+        with use_slave():
+            states = await asyncio.gather(child('master', 0.02), child('slave', 0.01), decorated())
+            return states, routers.state()
+
+    assert run(parent()) == (['master', 'slave', 'slave'], 'slave')
@@ -0,0 +1,115 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import pytest
+from mock import MagicMock
+
+from django_replicated.balancer import (
+    ReplicaStats, RandomBalancer, LeastLatencyBalancer, PowerOfTwoBalancer, get_balancer,
+    rendezvous_order,
+)
+from django_replicated.dbchecker import check_db
+
+
+@pytest.fixture
+def stats():
+    return ReplicaStats(alpha=0.5)
+
+
+def test_stats_ewma(stats):
+    stats.record('slave1', 1.0)
+    stats.record('slave1', 3.0)
+
+    assert stats.latency('slave1') == 2.0
+    assert stats.error_rate('slave1') == 0.0
+
+    stats.record('slave1', error=True)
+
+    assert stats.latency('slave1') == 2.0
+    assert stats.error_rate('slave1') == 0.5
+
+
+def test_random_balancer_zero_weight():
+    balancer = RandomBalancer(weights={'slave1': 0})
+
+    assert balancer.order(['slave1', 'slave2']) == ['slave2']
+
+
+def test_random_balancer_weights():
+    balancer = RandomBalancer(weights={'slave1': 100})
+
+    firsts = [balancer.order(['slave1', 'slave2'])[0] for _ in range(100)]
+
+    assert firsts.count('slave1') > 80
+
+
+def test_least_latency_balancer(stats):
+    stats.record('slave1', 0.5)
+    stats.record('slave2', 0.1)
+    stats.record('slave3', 0.2)
+    balancer = LeastLatencyBalancer(stats=stats)
+
+    assert balancer.order(['slave1', 'slave2', 'slave3']) == ['slave2', 'slave3', 'slave1']
+
+
+def test_least_latency_balancer_errors(stats):
+    stats.record('slave1', 0.1)
+    stats.record('slave1', error=True)
+    stats.record('slave2', 0.2)
+    balancer = LeastLatencyBalancer(stats=stats)
+
+    assert balancer.order(['slave1', 'slave2']) == ['slave2', 'slave1']
+
+
+def test_p2c_balancer(stats):
+    stats.record('slave1', 0.5)
+    stats.record('slave2', 0.1)
+    balancer = PowerOfTwoBalancer(stats=stats)
+
+    assert balancer.order(['slave1', 'slave2']) == ['slave2', 'slave1']
+
+
+def test_get_balancer():
+    assert isinstance(get_balancer('p2c'), PowerOfTwoBalancer)
+    assert isinstance(get_balancer('django_replicated.balancer.LeastLatencyBalancer'), LeastLatencyBalancer)
+    assert get_balancer('random', {'slave1': 2}).weights == {'slave1': 2}
+
+
+def test_check_db_records_stats():
+    from django_replicated.balancer import stats
+
+    stats.reset()
+    check_db(MagicMock(return_value=True), 'slave1')
+    check_db(MagicMock(side_effect=Exception), 'slave2')
+
+    assert stats.error_rate('slave1') == 0.0
+    assert stats.error_rate('slave2') > 0.0
+
+
+def test_rendezvous_order_is_stable():
+    aliases = ['slave%d' % i for i in range(5)]
+
+    for key in range(20):
+        order = rendezvous_order(key, aliases)
+        assert sorted(order) == aliases
+        assert rendezvous_order(key, list(reversed(aliases))) == order
+
+
+def test_rendezvous_order_minimal_remapping():
+    aliases = ['slave%d' % i for i in range(5)]
+    keys = range(200)
+    before = dict((key, rendezvous_order(key, aliases)[0]) for key in keys)
+    after = dict((key, rendezvous_order(key, aliases[1:])[0]) for key in keys)
+
+    moved = [key for key in keys if before[key] != after[key]]
+    assert moved
+    assert all(before[key] == 'slave0' for key in moved)
+
+
+def test_rendezvous_order_weights():
+    keys = range(1000)
+    weights = {'slave1': 3, 'slave2': 1, 'slave3': 0}
+    firsts = [rendezvous_order(key, ['slave1', 'slave2', 'slave3'], weights)[0] for key in keys]
+
+    assert 'slave3' not in firsts
+    assert 650 < firsts.count('slave1') < 850
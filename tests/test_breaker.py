@@ -0,0 +1,93 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import pytest
+from mock import MagicMock
+
+from django.core.cache import caches
+
+from django_replicated.breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+from django_replicated.dbchecker import cache, check_db, hostname
+
+
+@pytest.fixture
+def breaker_factory(clock):
+    caches['default'].clear()
+
+    def factory(**kwargs):
+        kwargs.setdefault('max_timeout', 40)
+        return CircuitBreaker(caches['default'], 'breaker', 10, clock=clock, **kwargs)
+
+    return factory
+
+
+def test_breaker_threshold(breaker_factory):
+    breaker_factory(threshold=2).failure()
+    assert breaker_factory(threshold=2).state() == CLOSED
+
+    breaker_factory(threshold=2).failure()
+    assert breaker_factory(threshold=2).state() == OPEN
+    assert not breaker_factory(threshold=2).allow()
+
+
+def test_breaker_half_open_single_probe(breaker_factory, clock):
+    breaker_factory().failure()
+    clock.now += 10
+
+    assert breaker_factory().state() == HALF_OPEN
+    assert breaker_factory().allow()
+    assert not breaker_factory().allow()
+
+
+def test_breaker_exponential_backoff(breaker_factory, clock):
+    for timeout in (10, 20, 40, 40):
+        breaker = breaker_factory()
+        breaker.allow()
+        breaker.failure()
+
+        clock.now += timeout - 1
+        assert breaker_factory().state() == OPEN
+        clock.now += 1
+        assert breaker_factory().state() == HALF_OPEN
+
+
+def test_breaker_success_closes(breaker_factory, clock):
+    breaker_factory().failure()
+    clock.now += 10
+
+    breaker = breaker_factory()
+    assert breaker.allow()
+    breaker.success()
+
+    assert breaker_factory().state() == CLOSED
+    assert breaker_factory().allow()
+
+
+def test_breaker_success_no_writes():
+    cache_mock = MagicMock()
+    cache_mock.get.return_value = None
+    breaker = CircuitBreaker(cache_mock, 'breaker', 10)
+
+    assert breaker.allow()
+    breaker.success()
+
+    cache_mock.set.assert_not_called()
+    cache_mock.delete.assert_not_called()
+
+
+def test_check_db_with_breaker(settings):
+    settings.REPLICATED_CIRCUIT_BREAKER = True
+    cache.shared.clear()
+    checker = MagicMock(return_value=False)
+
+    assert check_db(checker, 'slave1', 10) is False
+    assert check_db(checker, 'slave1', 10) is False
+    assert checker.call_count == 1
+
+    # Open period is over
+    cache.set('%s:MagicMock:slave1:breaker' % hostname, (1, 1, 0), 100)
+    checker.return_value = True
+
+    assert check_db(checker, 'slave1', 10) is True
+    assert check_db(checker, 'slave1', 10) is True
+    assert checker.call_count == 3
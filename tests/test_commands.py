@@ -0,0 +1,68 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import json
+
+import pytest
+from mock import patch
+from six import StringIO
+
+from django.core.management.base import CommandError
+
+from django_replicated import dbchecker
+from django_replicated.management.commands.replicated_status import Command, percentile
+
+
+pytestmark = pytest.mark.django_db
+
+
+def run(**options):
+    defaults = {'aliases': [], 'iterations': 1, 'json': True, 'watch': 0, 'check': False}
+    defaults.update(options)
+    stdout = StringIO()
+    Command(stdout=stdout).handle(**defaults)
+    return stdout.getvalue()
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([3, 1, 2], 50) == 2
+    assert percentile([3, 1, 2], 99) == 3
+
+
+def test_replicated_status_json():
+    key = dbchecker.get_cache_key('is_alive', 'slave2')
+    dbchecker.cache.set(key, dbchecker.DEAD_MARK, 10)
+    try:
+        output = json.loads(run(iterations=3))
+    finally:
+        dbchecker.cache.delete(key)
+
+    reports = dict((report['alias'], report) for report in output['databases'])
+    assert sorted(reports) == ['default', 'slave1', 'slave2']
+
+    assert reports['default']['role'] == 'master'
+    assert reports['slave1']['role'] == 'slave'
+    assert reports['slave1']['alive'] is True
+    assert reports['slave1']['latency']['max'] >= reports['slave1']['latency']['p50']
+    assert reports['slave1']['latency']['connect'] >= 0
+    assert reports['slave2']['cached']['is_alive'] == 'dead'
+    assert reports['slave1']['cached']['is_alive'] == 'ok'
+
+
+def test_replicated_status_table():
+    output = run(aliases=['slave1'], json=False)
+
+    assert 'slave1' in output
+    assert 'slave2' not in output
+
+
+def test_replicated_status_check():
+    with patch('django_replicated.dbchecker.run_checker', return_value=False):
+        with pytest.raises(CommandError):
+            run(check=True)
+
+
+def test_replicated_status_unknown_alias():
+    with pytest.raises(CommandError):
+        run(aliases=['unknown'])
@@ -1,11 +1,26 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
+import threading
+
+import pytest
 from mock import MagicMock, patch, call
 
 from django.db import connections
 
-from django_replicated.dbchecker import cache, check_db, hostname
+from django_replicated.dbchecker import cache, check_db, check_master, hostname
+
+
+def test_is_alive_queries_without_ping():
+    from django_replicated.dbchecker import is_alive
+
+    connection = MagicMock(spec=['alias', 'connection', 'cursor', 'features'])
+    connection.connection = object()
+    connection.features.bare_select_suffix = ''
+    cursor = connection.cursor.return_value.__enter__.return_value
+
+    assert is_alive(connection) is True
+    cursor.execute.assert_called_once_with('SELECT 1')
 
 
 def test_check_success():
@@ -66,3 +81,196 @@ def test_check_fail_get_cache_force():
 
         cache_get_mock.assert_not_called()
         checker.assert_called_once_with(connections['default'])
+
+
+def test_check_master():
+    writable = {'default': False, 'slave1': True}
+
+    with patch.object(cache, 'get', return_value=None), patch.object(cache, 'set') as cache_set_mock:
+        with patch('django_replicated.dbchecker.check_db') as check_db_mock:
+            check_db_mock.side_effect = (
+                lambda checker, db_name, *args: checker.__name__ == 'is_alive' or writable[db_name]
+            )
+
+            assert check_master('default', ['default', 'slave1'], 5) == 'slave1'
+            cache_set_mock.assert_called_once_with('%s:master:default' % hostname, 'slave1', 5)
+
+            writable['slave1'] = False
+            assert check_master('default', ['default', 'slave1'], 5) == 'default'
+
+
+def test_check_master_cached():
+    with patch.object(cache, 'get', return_value='slave1'):
+        with patch('django_replicated.dbchecker.check_db') as check_db_mock:
+            assert check_master('default', ['default', 'slave1'], 5) == 'slave1'
+            check_db_mock.assert_not_called()
+
+
+def test_replication_lag_unknown_vendor():
+    from django_replicated.dbchecker import replication_lag
+
+    assert replication_lag(MagicMock(vendor='sqlite')) is None
+
+
+def test_replication_lag_mysql():
+    from django_replicated.dbchecker import replication_lag
+
+    connection = MagicMock(vendor='mysql')
+    cursor = connection.cursor.return_value.__enter__.return_value
+    cursor.description = [('Slave_IO_State',), ('Seconds_Behind_Master',)]
+
+    cursor.fetchone.return_value = ('Waiting', 7)
+    assert replication_lag(connection) == 7.0
+
+    cursor.fetchone.return_value = ('', None)
+    assert replication_lag(connection) == float('inf')
+
+    cursor.fetchone.return_value = None
+    assert replication_lag(connection) == 0
+
+
+def test_replication_lag_postgresql():
+    from django_replicated.dbchecker import replication_lag
+
+    connection = MagicMock(vendor='postgresql', pg_version=120000)
+    cursor = connection.cursor.return_value.__enter__.return_value
+
+    cursor.fetchone.return_value = (3,)
+    assert replication_lag(connection) == 3.0
+    # Caught up replicas are only up to date while streaming
+    sql = cursor.execute.call_args[0][0]
+    assert 'pg_stat_wal_receiver' in sql and 'pg_last_wal_receive_lsn()' in sql
+
+    cursor.fetchone.return_value = (None,)
+    assert replication_lag(connection) == float('inf')
+
+    connection.pg_version = 90500
+    replication_lag(connection)
+    assert 'pg_stat_wal_receiver' not in cursor.execute.call_args[0][0]
+
+
+def test_parse_interval():
+    from django_replicated.dbchecker import parse_interval
+
+    assert parse_interval('+00 00:00:05.500') == 5.5
+    assert parse_interval('+01 02:03:04') == 93784
+
+
+def test_check_replication_lag_cache():
+    from django_replicated.dbchecker import check_replication_lag
+
+    with patch('django_replicated.dbchecker.replication_lag') as lag_mock:
+        lag_mock.return_value = 12.0
+
+        with patch.object(cache, 'set') as cache_set_mock:
+            assert check_replication_lag('slave1', 5) == 12.0
+            cache_set_mock.assert_called_once_with('%s:replication_lag:slave1' % hostname, 12.0, 5)
+
+        with patch.object(cache, 'get') as cache_get_mock:
+            cache_get_mock.return_value = 3.0
+
+            assert check_replication_lag('slave1', 5) == 3.0
+            lag_mock.assert_called_once_with(connections['slave1'])
+
+
+def test_check_replication_lag_error():
+    from django_replicated.dbchecker import check_replication_lag
+
+    with patch('django_replicated.dbchecker.replication_lag') as lag_mock:
+        lag_mock.side_effect = Exception
+
+        assert check_replication_lag('slave1') is None
+
+
+def test_health_batch():
+    from django_replicated.dbchecker import HealthBatch
+
+    checker = MagicMock(side_effect=lambda connection: connection.alias == 'slave2')
+    keys = ['%s:MagicMock:%s' % (hostname, alias) for alias in ('slave1', 'slave2', 'default')]
+
+    with patch.object(cache.shared, 'get_many') as get_many_mock:
+        get_many_mock.return_value = {keys[0]: 'dead'}
+
+        batch = HealthBatch(checker, ['slave1', 'slave2', 'default'], 10)
+
+        assert get_many_mock.call_count == 1
+        assert sorted(get_many_mock.call_args[0][0]) == sorted(keys)
+
+    with patch.object(cache.shared, 'get') as get_mock, patch.object(cache.shared, 'set_many') as set_many_mock:
+        assert batch.check('slave1') is False
+        assert batch.check('slave2') is True
+        assert batch.check('default') is False
+        assert checker.call_count == 2
+
+        batch.flush()
+        batch.flush()
+
+        assert get_mock.call_count == 0
+        assert set_many_mock.call_count == 1
+        set_many_mock.assert_called_with({keys[2]: 'dead'}, 10)
+
+
+def test_check_timeout(settings):
+    pytest.importorskip('concurrent.futures')
+    from django_replicated.dbchecker import run_check
+
+    settings.REPLICATED_CHECK_TIMEOUT = 0.05
+    release = threading.Event()
+    calls = []
+
+    def hanging_check(connection):
+        calls.append(connection.alias)
+        return release.wait(5)
+
+    try:
+        assert check_db(hanging_check, 'slave1', 10) is False
+        assert cache.get('%s:hanging_check:slave1' % hostname) == 'dead'
+
+        # The hanging check is not started again
+        assert run_check(hanging_check, 'slave1') is False
+        assert calls == ['slave1']
+    finally:
+        release.set()
+
+    def quick_check(connection):
+        return True
+
+    assert run_check(quick_check, 'slave1') is True
+    cache.delete('%s:hanging_check:slave1' % hostname)
+
+
+def test_check_timeout_releases_connection(settings):
+    pytest.importorskip('concurrent.futures')
+    from django_replicated.dbchecker import run_check
+
+    settings.REPLICATED_CHECK_TIMEOUT = 1
+
+    def closing_check(connection):
+        return True
+
+    with patch.object(type(connections['slave1']), 'close_if_unusable_or_obsolete') as close_mock:
+        assert run_check(closing_check, 'slave1') is True
+        assert close_mock.call_count == 1
+
+
+def test_health_batch_parallel(settings):
+    pytest.importorskip('concurrent.futures')
+    from django_replicated.dbchecker import HealthBatch
+
+    settings.REPLICATED_CHECK_TIMEOUT = 1
+    started = []
+    both_started = threading.Event()
+
+    def parallel_check(connection):
+        started.append(connection.alias)
+        if len(started) == 2:
+            both_started.set()
+        # Only succeeds if the other check runs at the same time
+        return both_started.wait(0.5)
+
+    batch = HealthBatch(parallel_check, ['slave1', 'slave2'])
+    batch.start(['slave1', 'slave2'])
+
+    assert batch.check('slave1') is True
+    assert batch.check('slave2') is True
+    assert sorted(started) == ['slave1', 'slave2']
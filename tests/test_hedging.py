@@ -0,0 +1,94 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import threading
+
+import pytest
+from mock import patch
+
+from django_replicated.utils import routers
+
+pytest.importorskip('concurrent.futures')
+
+from django_replicated.hedging import LatencyWindow, hedged_read, MIN_SAMPLES  # noqa: E402
+
+
+@pytest.fixture
+def candidates(request):
+    patcher = patch.object(routers.router, 'read_candidates', return_value=['slave1', 'slave2'])
+    patcher.start()
+    request.addfinalizer(patcher.stop)
+
+    routers.init('slave')
+    request.addfinalizer(routers.reset)
+
+
+def test_latency_window_percentile():
+    window = LatencyWindow()
+    window.record(1.0)
+
+    assert window.percentile(95, default=0.5) == 0.5
+
+    window.clear()
+    for value in range(MIN_SAMPLES * 5):
+        window.record(value)
+
+    assert window.percentile(50) == 50
+    assert window.percentile(100) == MIN_SAMPLES * 5 - 1
+
+
+def test_hedged_read_fast(candidates):
+    calls = []
+
+    def read(alias):
+        calls.append(alias)
+        return alias
+
+    assert hedged_read(read, delay=1) == 'slave1'
+    assert calls == ['slave1']
+
+
+def test_hedged_read_slow(candidates):
+    release = threading.Event()
+
+    def read(alias):
+        if alias == 'slave1':
+            release.wait(5)
+        return alias
+
+    try:
+        assert hedged_read(read, delay=0.01) == 'slave2'
+    finally:
+        release.set()
+
+
+def test_hedged_read_failure(candidates):
+    def read(alias):
+        if alias == 'slave1':
+            raise ValueError(alias)
+        return alias
+
+    assert hedged_read(read, delay=1) == 'slave2'
+
+
+def test_hedged_read_all_failed(candidates):
+    def read(alias):
+        raise ValueError(alias)
+
+    with pytest.raises(ValueError):
+        hedged_read(read, delay=0)
+
+
+def test_hedged_read_routes_queries(candidates):
+    assert hedged_read(lambda alias: routers.db_for_read(), delay=1) == 'slave1'
+    assert routers.state() == 'slave'
+
+
+def test_hedged_read_master_state():
+    routers.init('master')
+    try:
+        assert hedged_read(lambda alias: (alias, threading.current_thread())) == (
+            'default', threading.current_thread()
+        )
+    finally:
+        routers.reset()
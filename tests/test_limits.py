@@ -0,0 +1,91 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import pytest
+from mock import patch
+
+from django.core.cache import cache
+
+from django_replicated.limits import Limiter
+
+
+@pytest.fixture(params=['local', 'shared'])
+def make_limiter(request, clock):
+    cache.clear()
+    request.addfinalizer(cache.clear)
+    shared = cache if request.param == 'shared' else None
+
+    def make(limits):
+        return Limiter(limits, shared, clock=clock)
+
+    return make
+
+
+def test_concurrency(make_limiter):
+    limiter = make_limiter({'slave1': {'concurrency': 2}})
+
+    assert limiter.acquire('slave1')
+    assert limiter.acquire('slave1')
+    assert not limiter.acquire('slave1')
+    assert limiter.inflight('slave1') == 2
+
+    # Untracked operations are not limited by concurrency
+    assert limiter.acquire('slave1', track=False)
+
+    limiter.release('slave1')
+    assert limiter.acquire('slave1')
+
+
+def test_rate(make_limiter, clock):
+    limiter = make_limiter({'slave1': {'rate': 2}})
+
+    assert limiter.acquire('slave1', track=False)
+    assert limiter.acquire('slave1')
+    assert not limiter.acquire('slave1')
+
+    clock.now += 1
+    assert limiter.acquire('slave1')
+
+
+def test_rate_does_not_leak_concurrency(make_limiter):
+    limiter = make_limiter({'slave1': {'rate': 1, 'concurrency': 5}})
+
+    assert limiter.acquire('slave1')
+    assert not limiter.acquire('slave1')
+    assert limiter.inflight('slave1') == 1
+
+
+def test_shared_concurrency_expiry(clock):
+    if not hasattr(cache, 'touch'):
+        pytest.skip('cache backends without touch do not extend expiry')
+
+    cache.clear()
+    limiter = Limiter({'slave1': {'concurrency': 1}}, cache)
+    with patch('django.core.cache.backends.locmem.time.time', clock):
+        assert limiter.acquire('slave1')
+
+        # Busy counters do not expire
+        clock.now += 50
+        assert not limiter.acquire('slave1')
+        clock.now += 50
+        assert not limiter.acquire('slave1')
+        assert limiter.inflight('slave1') == 1
+
+        # Counters of crashed processes do, releases do not go below zero
+        clock.now += 100
+        assert limiter.inflight('slave1') == 0
+        limiter.release('slave1')
+        assert limiter.inflight('slave1') == 0
+        assert limiter.acquire('slave1')
+        assert not limiter.acquire('slave1')
+
+    cache.clear()
+
+
+def test_unlimited(make_limiter):
+    limiter = make_limiter({})
+
+    assert 'slave1' not in limiter
+    for _ in range(10):
+        assert limiter.acquire('slave1')
+    limiter.release('slave1')
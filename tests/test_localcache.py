@@ -0,0 +1,74 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+from mock import MagicMock
+
+from django_replicated.localcache import LocalCache, TieredCache
+
+
+def test_local_cache_ttl(clock):
+    cache = LocalCache(clock=clock)
+    cache.set('key', 'value', 5)
+
+    assert cache.get('key') == 'value'
+
+    clock.now += 5
+    assert cache.get('key') is None
+
+
+def test_local_cache_lru_eviction():
+    cache = LocalCache(max_size=2)
+    cache.set('a', 1, 10)
+    cache.set('b', 2, 10)
+    cache.get('a')
+    cache.set('c', 3, 10)
+
+    assert len(cache) == 2
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+
+def test_tiered_cache_disabled():
+    shared = MagicMock()
+    cache = TieredCache(shared)
+
+    cache.get('key')
+    cache.get('key')
+
+    assert shared.get.call_count == 2
+
+
+def test_tiered_cache_caches_misses():
+    shared = MagicMock()
+    shared.get.side_effect = lambda key, default: default
+    cache = TieredCache(shared, local_seconds=1)
+
+    assert cache.get('key') is None
+    assert cache.get('key', 'default') == 'default'
+
+    assert shared.get.call_count == 1
+
+
+def test_tiered_cache_write_through():
+    shared = MagicMock()
+    cache = TieredCache(shared, local_seconds=1)
+
+    cache.set('key', 'dead', 10)
+
+    shared.set.assert_called_once_with('key', 'dead', 10)
+    assert cache.get('key') == 'dead'
+    shared.get.assert_not_called()
+
+
+def test_tiered_cache_get_many():
+    shared = MagicMock()
+    shared.get_many.return_value = {'b': 'dead'}
+    cache = TieredCache(shared, local_seconds=1)
+    cache.set('a', 'dead', 10)
+
+    assert cache.get_many(['a', 'b', 'c']) == {'a': 'dead', 'b': 'dead'}
+    shared.get_many.assert_called_once_with(['b', 'c'])
+
+    assert cache.get_many(['a', 'b', 'c']) == {'a': 'dead', 'b': 'dead'}
+    shared.get_many.assert_called_once_with(['b', 'c'])
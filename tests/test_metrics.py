@@ -0,0 +1,90 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import pytest
+from mock import MagicMock, patch
+
+from django_replicated.dbchecker import cache, check_db, hostname
+from django_replicated.metrics import metrics, InMemorySink, StatsdSink, load_sink, CallbackSink
+from django_replicated.router import ReplicationRouter
+
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def sink(request):
+    sink = InMemorySink(buckets=(0.1, 1))
+    metrics.add_sink(sink)
+    request.addfinalizer(metrics.clear)
+    return sink
+
+
+def test_disabled():
+    assert not metrics.enabled
+    metrics.incr('reads', alias='default')
+
+
+def test_in_memory_sink(sink):
+    metrics.incr('reads', alias='slave1')
+    metrics.incr('reads', 2, alias='slave1')
+    metrics.observe('probe_seconds', 0.5, alias='slave1', check='is_alive')
+
+    assert sink.counter('reads', alias='slave1') == 3
+    assert sink.render_prometheus() == '\n'.join([
+        '# TYPE replicated_reads_total counter',
+        'replicated_reads_total{alias="slave1"} 3',
+        '# TYPE replicated_probe_seconds histogram',
+        'replicated_probe_seconds_bucket{alias="slave1",check="is_alive",le="0.1"} 0',
+        'replicated_probe_seconds_bucket{alias="slave1",check="is_alive",le="1.0"} 1',
+        'replicated_probe_seconds_bucket{alias="slave1",check="is_alive",le="+Inf"} 1',
+        'replicated_probe_seconds_sum{alias="slave1",check="is_alive"} 0.5',
+        'replicated_probe_seconds_count{alias="slave1",check="is_alive"} 1',
+    ]) + '\n'
+
+
+def test_statsd_sink():
+    client = MagicMock()
+    sink = StatsdSink(client)
+
+    sink.incr('reads', 1, (('alias', 'slave1'),))
+    sink.observe('probe_seconds', 0.5, (('alias', 'slave1'),))
+
+    client.incr.assert_called_once_with('replicated.reads.slave1', 1)
+    client.timing.assert_called_once_with('replicated.probe_seconds.slave1', 500)
+
+
+def test_load_sink():
+    assert isinstance(load_sink('django_replicated.metrics.InMemorySink'), InMemorySink)
+    assert isinstance(load_sink(lambda *args: None), CallbackSink)
+
+    with pytest.raises(ValueError):
+        load_sink(42)
+
+
+def test_router_metrics(sink):
+    router = ReplicationRouter()
+    router.use_state('slave')
+
+    with patch.object(router, 'is_alive', return_value=False):
+        assert router.db_for_read() == 'default'
+        assert router.db_for_read() == 'default'
+
+    router.use_state('master')
+    router.db_for_write()
+
+    assert sink.counter('reads', alias='default') == 2
+    assert sink.counter('writes', alias='default') == 1
+    assert sink.counter('fallbacks_to_master', cluster='default') == 1
+
+
+def test_check_db_metrics(sink):
+    checker = MagicMock(return_value=False)
+    cache.delete('%s:MagicMock:slave1' % hostname)
+
+    check_db(checker, 'slave1', 10)
+    check_db(checker, 'slave1', 10)
+
+    assert sink.counter('dead_mark_misses', alias='slave1', check='MagicMock') == 1
+    assert sink.counter('dead_mark_hits', alias='slave1', check='MagicMock') == 1
+    assert sink.histograms['probe_seconds', (('alias', 'slave1'), ('check', 'MagicMock'))][-1] == 1
@@ -131,26 +131,53 @@ def test_disable_manage_atomic_requests(_request):
 
 
 def test_non_atomic_view(client):
-    from ._test_urls import non_atomic_view as view
-
     with override_settings(REPLICATED_MANAGE_ATOMIC_REQUESTS=True):
-        assert not hasattr(view, '_replicated_view_default_non_atomic_dbs')
-
         with patch('django.db.transaction.atomic') as atomic:
             atomic.return_value = lambda view: view
 
-            client.post('/non_atomic_view')
+            response = client.post('/non_atomic_view')
             atomic.assert_not_called()
-            assert view._replicated_view_default_non_atomic_dbs == {'default'}
-            assert view._non_atomic_requests == {'default', 'slave1', 'slave2'}
+            assert response['Default-Non-Atomic'] == 'default'
+            assert response['Non-Atomic'] == 'default,slave1,slave2'
 
         with patch('django.db.transaction.atomic') as atomic:
             atomic.return_value = lambda view: view
 
             response = client.get('/non_atomic_view')
             atomic.assert_not_called()
-            assert view._replicated_view_default_non_atomic_dbs == {'default'}
-            assert view._non_atomic_requests == {'default', 'slave1', 'slave2'} - {response['DB-Used']}
+            assert response['Default-Non-Atomic'] == 'default'
+            assert response['Non-Atomic'] == ','.join(sorted({'default', 'slave1', 'slave2'} - {response['DB-Used']}))
+
+
+def test_non_atomic_dbs_follow_routing_context():
+    from django_replicated.middleware import NonAtomicDatabases, ReplicationMiddleware
+    from django_replicated.utils import routers
+
+    def view(request):
+        pass
+
+    view._non_atomic_requests = {'other'}
+    middleware = ReplicationMiddleware()
+    middleware.set_non_atomic_dbs(view)
+    non_atomic = view._non_atomic_requests
+    assert isinstance(non_atomic, NonAtomicDatabases)
+
+    # Installed once, not replaced per request
+    middleware.set_non_atomic_dbs(view)
+    assert view._non_atomic_requests is non_atomic
+
+    router = routers.router
+    router.init('master')
+    try:
+        assert 'default' not in non_atomic
+        assert 'slave1' in non_atomic and 'other' in non_atomic
+
+        router.init('slave')
+        slave = router.db_for_read()
+        assert slave not in non_atomic
+        assert 'default' in non_atomic
+    finally:
+        router.reset()
 
 
 @pytest.mark.parametrize('url', ['/', '/with_name', '/as_callable', '/as_instancemethod'])
@@ -179,3 +206,129 @@ def test_atomic_view(client, url):
             atomic.assert_called_once_with(using='default')
             assert response['Default-Non-Atomic'] == ''
             assert response['Non-Atomic'] == ','.join(sorted({'default', 'slave1', 'slave2'} - {response['DB-Used']}))
+
+
+def test_view_overrides_skip_resolve():
+    from django_replicated.middleware import ViewOverrides
+
+    index = ViewOverrides({'/admin/*': 'master', '/users/*/posts/*': 'slave'})
+
+    with patch('django_replicated.middleware.urls.resolve') as resolve_mock:
+        assert index.match('/admin/auth/') == 'master'
+        assert index.match('/users/1/posts/2') == 'slave'
+        assert index.match('/other/') is None
+        resolve_mock.assert_not_called()
+
+
+def test_view_overrides_first_match_wins():
+    from collections import OrderedDict
+    from django_replicated.middleware import ViewOverrides
+
+    index = ViewOverrides(OrderedDict([
+        ('/admin/auth/', 'slave'),
+        ('tests._test_urls.TestView', 'master'),
+    ]))
+    assert index.match('/admin/auth/') == 'slave'
+
+    index = ViewOverrides(OrderedDict([
+        ('tests._test_urls.TestView', 'master'),
+        ('/admin/*', 'slave'),
+    ]))
+    assert index.match('/admin/auth/') == 'master'
+
+
+def test_view_overrides_resolve_cache():
+    from django_replicated.middleware import ViewOverrides, urls
+
+    index = ViewOverrides({'view-name': 'master'})
+
+    with patch.object(urls, 'resolve', wraps=urls.resolve) as resolve_mock:
+        assert index.match('/with_name') == 'master'
+        assert index.match('/with_name') == 'master'
+        assert index.match('/') is None
+        assert resolve_mock.call_count == 2
+
+
+def test_position_encoding():
+    from django_replicated.middleware import encode_position, decode_position
+
+    position = '3e11fa47-71ca-11e1-9e33-c80aa9429562:1-5,\n4e11fa47-71ca-11e1-9e33-c80aa9429562:1-2'
+
+    assert decode_position(encode_position(position)) == position
+    assert decode_position(encode_position('0/3000060')) == '0/3000060'
+    assert decode_position('true') is None
+    assert decode_position('pos:%%%') is None
+    assert decode_position(None) is None
+
+
+def test_read_your_writes_cookie(client):
+    from django_replicated.middleware import encode_position
+
+    with override_settings(REPLICATED_READ_YOUR_WRITES=True):
+        with patch('django_replicated.dbchecker.replication_position', return_value='0/3000060'), \
+                patch('django_replicated.router.ReplicationRouter.db_for_write') as db_for_write_mock:
+            client.post('/')
+
+            # Looking up the master is not a write
+            db_for_write_mock.assert_not_called()
+
+        cookie = client.cookies[settings.REPLICATED_FORCE_MASTER_COOKIE_NAME].value
+        assert cookie == encode_position('0/3000060')
+
+        with patch('django_replicated.router.ReplicationRouter.has_replayed') as has_replayed_mock:
+            has_replayed_mock.side_effect = lambda db_name, position: db_name == 'slave2'
+
+            response = client.get('/')
+
+            assert response['Router-Used'] == 'slave'
+            assert response['DB-Used'] == 'slave2'
+            assert has_replayed_mock.call_args[0][1] == '0/3000060'
+
+
+def test_read_your_writes_not_replayed(client):
+    with override_settings(REPLICATED_READ_YOUR_WRITES=True):
+        with patch('django_replicated.dbchecker.replication_position', return_value='0/3000060'):
+            client.post('/')
+
+        with patch('django_replicated.router.ReplicationRouter.has_replayed', return_value=False):
+            response = client.get('/')
+
+            assert response['Router-Used'] == 'slave'
+            assert response['DB-Used'] == 'default'
+
+
+def test_read_your_writes_unsupported_vendor(client):
+    with override_settings(REPLICATED_READ_YOUR_WRITES=True):
+        client.post('/')
+
+        assert client.cookies[settings.REPLICATED_FORCE_MASTER_COOKIE_NAME].value == 'true'
+
+
+def test_affinity_by_session_cookie(client):
+    from django_replicated.balancer import rendezvous_order
+
+    client.cookies[settings.SESSION_COOKIE_NAME] = 'some-session'
+    expected = rendezvous_order('some-session', ['slave1', 'slave2'])[0]
+
+    with override_settings(REPLICATED_AFFINITY='session'):
+        for _ in range(3):
+            assert client.get('/')['DB-Used'] == expected
+
+
+def test_affinity_callable(client):
+    from django_replicated.balancer import rendezvous_order
+
+    key = rendezvous_order('client', ['slave1', 'slave2'])
+
+    with override_settings(REPLICATED_AFFINITY=lambda request: request.GET.get('client')):
+        assert client.get('/', {'client': 'client'})['DB-Used'] == key[0]
+
+
+def test_affinity_without_key(_request):
+    from django_replicated.middleware import ReplicationMiddleware
+
+    middleware = ReplicationMiddleware()
+    with override_settings(REPLICATED_AFFINITY='session'):
+        assert middleware.get_affinity_key(_request) is None
+    with override_settings(REPLICATED_AFFINITY='user'):
+        assert middleware.get_affinity_key(_request) is None
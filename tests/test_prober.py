@@ -0,0 +1,88 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import time
+
+import pytest
+from mock import patch
+
+from django.db import connections
+from django_replicated.dbchecker import cache
+from django_replicated.prober import Health, HealthProber
+
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def prober():
+    prober = HealthProber(['default', 'slave1'], interval=10)
+    prober.ensure_running = lambda: None
+    return prober
+
+
+def test_probe(prober):
+    with patch('django_replicated.dbchecker.check_db') as check_db_mock:
+        with patch('django_replicated.dbchecker.check_replication_lag') as lag_mock:
+            check_db_mock.side_effect = lambda checker, alias, *args, **kwargs: alias == 'default'
+            lag_mock.return_value = 0
+
+            assert prober.probe() == {
+                'default': Health(True, True, 0),
+                'slave1': Health(False, False, None),
+            }
+
+
+def test_current_snapshot(prober):
+    assert prober.current() is None
+
+    snapshot = {'slave1': Health(True, False, 1.0)}
+    prober.publish(snapshot, time.time())
+
+    assert prober.current() == snapshot
+    assert prober.health('slave1').lag == 1.0
+    assert prober.health('slave2') is None
+
+
+def test_stale_snapshot(prober):
+    prober.publish({'slave1': Health(True, False, 1.0)}, time.time() - 31)
+
+    assert prober.current() is None
+    assert prober.health('slave1') is None
+
+
+def test_shared_follower(prober):
+    prober.shared = True
+    snapshot = {'slave1': Health(True, False, 0)}
+
+    with patch.object(cache, 'add', return_value=False):
+        with patch.object(cache, 'get', return_value=(time.time(), snapshot)):
+            with patch.object(prober, 'probe') as probe_mock:
+                prober.run_once()
+
+                probe_mock.assert_not_called()
+
+    assert prober.current() == snapshot
+
+
+def test_shared_leader(prober):
+    prober.shared = True
+    snapshot = {'slave1': Health(True, False, 0)}
+
+    with patch.object(cache, 'add', return_value=True):
+        with patch.object(cache, 'set') as cache_set_mock:
+            with patch.object(prober, 'probe', return_value=snapshot):
+                prober.run_once()
+
+                assert cache_set_mock.call_args[0][0] == prober.snapshot_key
+                assert cache_set_mock.call_args[0][1][1] == snapshot
+
+    assert prober.current() == snapshot
+
+
+def test_run_once_releases_connections(prober):
+    with patch.object(prober, 'probe', return_value={}):
+        with patch.object(type(connections['slave1']), 'close_if_unusable_or_obsolete') as close_mock:
+            prober.run_once()
+
+            assert close_mock.call_count == 2
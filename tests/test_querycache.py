@@ -0,0 +1,132 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import pytest
+from mock import patch
+
+from django.db import connections, models
+
+from django_replicated import querycache
+from django_replicated.querycache import cached_queryset
+from django_replicated.utils import routers
+
+
+pytestmark = pytest.mark.django_db
+
+ALIASES = ('default', 'slave1', 'slave2')
+
+
+class CachedItem(models.Model):
+    name = models.CharField(max_length=10)
+
+    class Meta:
+        app_label = 'django_replicated'
+
+
+@pytest.fixture
+def items(request, settings):
+    settings.REPLICATED_QUERY_CACHE = True
+    settings.REPLICATED_QUERY_CACHE_SETTLE = 0
+
+    for alias in ALIASES:
+        with connections[alias].cursor() as cursor:
+            cursor.execute(
+                'CREATE TABLE django_replicated_cacheditem '
+                '(id integer PRIMARY KEY AUTOINCREMENT, name varchar(10) NOT NULL)'
+            )
+        CachedItem.objects.using(alias).create(name='a')
+
+    def teardown():
+        # Only the default database is rolled back after tests
+        for alias in ALIASES:
+            with connections[alias].cursor() as cursor:
+                cursor.execute('DROP TABLE IF EXISTS django_replicated_cacheditem')
+        querycache.get_entries().clear()
+        querycache.shared_cache().delete(querycache.write_key(CachedItem._meta.db_table))
+        routers.reset()
+
+    request.addfinalizer(teardown)
+    routers.init('slave')
+
+
+def names():
+    # Unpickling model instances requires an installed app
+    return cached_queryset(CachedItem.objects.values_list('name', flat=True))
+
+
+def update_slaves(name):
+    # Queryset updates do not send signals
+    for alias in ALIASES:
+        CachedItem.objects.using(alias).update(name=name)
+
+
+def test_cached(items):
+    assert names() == ['a']
+    update_slaves('b')
+    assert names() == ['a']
+
+
+def test_invalidated_by_write(items):
+    assert names() == ['a']
+    update_slaves('b')
+
+    routers.use_state('master')
+    with patch.object(routers.router, 'QUERY_CACHE', True):
+        routers.db_for_write(CachedItem)
+    routers.revert()
+
+    assert names() == ['b']
+
+
+def test_invalidated_by_signals(items):
+    querycache.install_invalidation()
+
+    assert names() == ['a']
+    item = CachedItem.objects.using('slave1').get()
+    item.name = 'b'
+    item.save(using='slave1')
+
+    # The same result whichever slave is read
+    update_slaves('b')
+    assert names() == ['b']
+
+
+def test_invalidated_by_commit(items):
+    from django.db import transaction
+
+    with patch('django.db.transaction.on_commit') as on_commit_mock:
+        with transaction.atomic(using='default'):
+            querycache.invalidate_model(CachedItem, 'default')
+
+    assert on_commit_mock.call_count == 1
+    assert on_commit_mock.call_args[1] == {'using': 'default'}
+
+    # Read before the commit, later than the settle window
+    assert names() == ['a']
+    update_slaves('b')
+    assert names() == ['a']
+
+    with patch.object(querycache.time, 'time', return_value=querycache.time.time() + 1):
+        on_commit_mock.call_args[0][0]()
+    assert names() == ['b']
+
+
+def test_recent_writes_not_cached(items, settings):
+    settings.REPLICATED_QUERY_CACHE_SETTLE = 60
+    querycache.invalidate_model(CachedItem)
+
+    assert names() == ['a']
+    update_slaves('b')
+    assert names() == ['b']
+
+
+def test_master_state_not_cached(items):
+    routers.use_state('master')
+    assert names() == ['a']
+    update_slaves('b')
+    assert names() == ['b']
+    assert len(querycache.get_entries()) == 0
+
+
+def test_empty_result(items):
+    assert cached_queryset(CachedItem.objects.filter(pk__in=[])) == []
@@ -61,3 +61,378 @@ def test_router_allow_relation(model):
     obj2._state.db = 'slave2'
 
     assert django_router.allow_relation(obj1, obj2)
+
+
+def test_router_sticky_after_write(model, settings):
+    settings.REPLICATED_CHECK_STATE_ON_WRITE = False
+    settings.REPLICATED_STICKY_AFTER_WRITE = True
+    router = ReplicationRouter()
+    router.init('slave')
+
+    class _OtherModel(models.Model):
+        class Meta:
+            app_label = 'django_replicated'
+
+    assert router.db_for_read(model) in ('slave1', 'slave2')
+    router.db_for_write(model)
+    assert router.db_for_read(model) == db.DEFAULT_DB_ALIAS
+    assert router.read_candidates(model) == [db.DEFAULT_DB_ALIAS]
+    assert router.db_for_read(_OtherModel) in ('slave1', 'slave2')
+
+    router.init('slave')
+    assert router.db_for_read(model) in ('slave1', 'slave2')
+
+
+def test_router_sticky_after_write_all(model, settings):
+    settings.REPLICATED_CHECK_STATE_ON_WRITE = False
+    settings.REPLICATED_STICKY_AFTER_WRITE = 'all'
+    router = ReplicationRouter()
+    router.init('slave')
+
+    router.db_for_write(model)
+    assert router.db_for_read() == db.DEFAULT_DB_ALIAS
+
+    # Writes in nested states stick too
+    router.init('slave')
+    router.enter_state('slave')
+    router.db_for_write(model)
+    router.exit_state()
+    assert router.db_for_read(model) == db.DEFAULT_DB_ALIAS
+
+
+def test_router_sticky_after_write_unknown_mode(settings):
+    from django.core.exceptions import ImproperlyConfigured
+
+    settings.REPLICATED_STICKY_AFTER_WRITE = 'tables'
+
+    with pytest.raises(ImproperlyConfigured):
+        ReplicationRouter()
+
+
+def test_router_db_for_read_weights(model, settings):
+    settings.REPLICATED_SLAVE_WEIGHTS = {'slave1': 0}
+    router = ReplicationRouter()
+    router.use_state('slave')
+
+    assert router.db_for_read(model) == 'slave2'
+
+
+def test_router_db_for_read_affinity(model):
+    from django_replicated.balancer import rendezvous_order
+
+    router = ReplicationRouter()
+    preferred = rendezvous_order('client', ['slave1', 'slave2'])
+
+    for _ in range(5):
+        router.init('slave')
+        router.set_affinity('client')
+        assert router.db_for_read(model) == preferred[0]
+
+    with mock.patch.object(router, 'is_alive', side_effect=lambda db, batch=None: db != preferred[0]):
+        router.init('slave')
+        router.set_affinity('client')
+        assert router.db_for_read(model) == preferred[1]
+
+
+def test_router_set_affinity_resets_chosen_slave(model):
+    from django_replicated.balancer import rendezvous_order
+
+    router = ReplicationRouter()
+    router.use_state('slave')
+    router.context.chosen[('default', 'slave')] = 'unused'
+    router.set_affinity('client')
+
+    assert router.db_for_read(model) == rendezvous_order('client', ['slave1', 'slave2'])[0]
+
+
+def test_router_read_candidates(model):
+    router = ReplicationRouter()
+    router.use_state('slave')
+
+    assert sorted(router.read_candidates(model)) == ['slave1', 'slave2']
+    assert router.context.chosen == {}
+
+    with mock.patch.object(router, 'is_alive', return_value=False):
+        assert router.read_candidates(model) == [db.DEFAULT_DB_ALIAS]
+
+    router.use_state('master')
+    assert router.read_candidates(model) == [db.DEFAULT_DB_ALIAS]
+
+
+def test_router_slave_limits(model, settings):
+    settings.REPLICATED_SLAVE_LIMITS = {'slave1': {'concurrency': 1}, 'slave2': {'concurrency': 1}}
+    settings.REPLICATED_SLAVE_WEIGHTS = {'slave1': 2}
+    router = ReplicationRouter()
+
+    chosen = set()
+    for _ in range(2):
+        router.init('slave')
+        chosen.add(router.db_for_read(model))
+        # Another request in the same process
+        router._context.set(None)
+    assert chosen == {'slave1', 'slave2'}
+
+    # Both saturated, no master budget: the best slave anyway
+    router.init('slave')
+    assert router.db_for_read(model) in ('slave1', 'slave2')
+    assert router.limiter.inflight('slave1') == 1
+
+    router.reset()
+    router.init('slave')
+    assert router.db_for_read(model) in ('slave1', 'slave2')
+
+
+def test_router_master_read_budget(model, settings):
+    settings.REPLICATED_SLAVE_LIMITS = {'slave1': {'concurrency': 0}, 'slave2': {'concurrency': 0}}
+    settings.REPLICATED_MASTER_READ_BUDGET = {'concurrency': 1}
+    router = ReplicationRouter()
+
+    router.init('slave')
+    assert router.db_for_read(model) == db.DEFAULT_DB_ALIAS
+    assert router.limiter.inflight('master:default') == 1
+    first = router.context
+
+    router._context.set(None)
+    router.init('slave')
+    assert router.db_for_read(model) in ('slave1', 'slave2')
+
+    router._context.set(first)
+    router.reset()
+    assert router.limiter.inflight('master:default') == 0
+
+
+def test_router_limits_unmanaged_context(model, settings):
+    settings.REPLICATED_SLAVE_LIMITS = {'slave1': {'concurrency': 1}}
+    router = ReplicationRouter()
+
+    for _ in range(3):
+        router.use_state('slave')
+        router.context.chosen.clear()
+        router.db_for_read(model)
+
+    assert router.limiter.inflight('slave1') == 0
+
+
+def test_router_db_for_read_batches_health_checks(model):
+    from django_replicated import dbchecker
+
+    router = ReplicationRouter()
+    router.use_state('slave')
+
+    with mock.patch.object(dbchecker.cache.shared, 'get_many', return_value={}) as get_many_mock, \
+            mock.patch.object(dbchecker.cache.shared, 'get') as get_mock, \
+            mock.patch.object(dbchecker.cache.shared, 'set_many') as set_many_mock, \
+            mock.patch('django_replicated.dbchecker.run_checker', return_value=False):
+        assert router.db_for_read(model) == db.DEFAULT_DB_ALIAS
+
+        assert get_many_mock.call_count == 1
+        assert get_mock.call_count == 0
+        assert set_many_mock.call_count == 1
+        assert len(set_many_mock.call_args[0][0]) == 2
+
+
+def test_router_db_for_read_check_timeout(model, settings):
+    import threading
+
+    pytest.importorskip('concurrent.futures')
+    from django_replicated import dbchecker
+
+    settings.REPLICATED_CHECK_TIMEOUT = 0.2
+    settings.REPLICATED_SLAVE_WEIGHTS = {'slave1': 1000}
+    router = ReplicationRouter()
+    router.use_state('slave')
+    release = threading.Event()
+
+    def checker(checker, db_name, number_of_tries):
+        return db_name != 'slave1' or release.wait(5)
+
+    try:
+        with mock.patch('django_replicated.dbchecker.run_checker', side_effect=checker) as run_checker_mock:
+            assert router.db_for_read(model) == 'slave2'
+            assert sorted(c[0][1] for c in run_checker_mock.call_args_list) == ['slave1', 'slave2']
+    finally:
+        release.set()
+        dbchecker.cache.delete(dbchecker.get_cache_key('is_alive', 'slave1'))
+
+
+def test_router_db_for_read_skips_lagging(model, settings):
+    settings.REPLICATED_MAX_REPLICATION_LAG = 10
+    router = ReplicationRouter()
+    router.use_state('slave')
+
+    lags = {'slave1': 30.0, 'slave2': 1.0}
+    with mock.patch('django_replicated.dbchecker.db_replication_lag', side_effect=lambda db, *a: lags[db]):
+        assert router.db_for_read(model) == 'slave2'
+
+
+def test_router_db_for_read_all_lagging(model, settings):
+    settings.REPLICATED_MAX_REPLICATION_LAG = 10
+    router = ReplicationRouter()
+    router.use_state('slave')
+
+    with mock.patch('django_replicated.dbchecker.db_replication_lag', return_value=float('inf')):
+        assert router.db_for_read(model) == db.DEFAULT_DB_ALIAS
+
+
+def test_router_db_for_read_probe_snapshot(model, settings):
+    from django_replicated.prober import Health
+
+    settings.REPLICATED_PROBE_INTERVAL = 10
+    router = ReplicationRouter()
+    router.use_state('slave')
+
+    snapshot = {'slave1': Health(False, False, None), 'slave2': Health(True, False, 0)}
+    with mock.patch.object(router.prober, 'current', return_value=snapshot):
+        with mock.patch('django_replicated.dbchecker.db_is_alive') as db_is_alive_mock:
+            assert router.db_for_read(model) == 'slave2'
+            db_is_alive_mock.assert_not_called()
+
+
+def test_router_master_discovery(model, settings):
+    settings.REPLICATED_MASTER_DISCOVERY = True
+    router = ReplicationRouter()
+
+    with mock.patch('django_replicated.dbchecker.check_master', return_value='slave1') as check_master_mock:
+        router.init('master')
+        assert router.db_for_write(model) == 'slave1'
+        assert router.db_for_read(model) == 'slave1'
+
+        # The old master is a slave now, the promoted one is not
+        router.init('slave')
+        for _ in range(10):
+            router.context.chosen.pop(('default', 'slave'), None)
+            assert router.db_for_read(model) in ('slave2', db.DEFAULT_DB_ALIAS)
+
+    assert check_master_mock.call_count == 2
+    check_master_mock.assert_called_with('default', ['default', 'slave1', 'slave2'], 5, router.DOWNTIME)
+
+
+def test_router_master_discovery_outside_requests(model, settings):
+    settings.REPLICATED_MASTER_DISCOVERY = True
+    router = ReplicationRouter()
+    router.reset()
+
+    with mock.patch('django_replicated.dbchecker.check_master') as check_master_mock, \
+            mock.patch('django_replicated.router.time.time', return_value=1000.0) as time_mock:
+        check_master_mock.return_value = db.DEFAULT_DB_ALIAS
+        assert router.db_for_write(model) == db.DEFAULT_DB_ALIAS
+        assert router.db_for_write(model) == db.DEFAULT_DB_ALIAS
+        assert check_master_mock.call_count == 1
+
+        # Contexts without init live as long as the thread, a failover is
+        # followed once the discovery is stale
+        check_master_mock.return_value = 'slave1'
+        time_mock.return_value += 5
+        assert router.db_for_write(model) == 'slave1'
+        assert check_master_mock.call_count == 2
+
+        # Nested states share the discovery
+        check_master_mock.return_value = db.DEFAULT_DB_ALIAS
+        router.enter_state('master')
+        assert router.db_for_write(model) == 'slave1'
+        time_mock.return_value += 5
+        assert router.db_for_write(model) == db.DEFAULT_DB_ALIAS
+        router.exit_state()
+        assert check_master_mock.call_count == 3
+
+
+def test_router_master_discovery_probe_snapshot(model, settings):
+    from django_replicated.prober import Health
+
+    settings.REPLICATED_MASTER_DISCOVERY = True
+    settings.REPLICATED_PROBE_INTERVAL = 10
+    router = ReplicationRouter()
+
+    snapshot = {
+        'default': Health(False, False, None),
+        'slave1': Health(True, False, 0),
+        'slave2': Health(True, True, 0),
+    }
+    with mock.patch.object(router.prober, 'current', return_value=snapshot):
+        assert router.db_for_write(model) == 'slave2'
+
+
+def test_router_model_route_master(model, settings):
+    settings.REPLICATED_MODEL_ROUTES = {'django_replicated._TestModel': 'master'}
+    router = ReplicationRouter()
+    router.use_state('slave')
+
+    assert router.db_for_read(model) == db.DEFAULT_DB_ALIAS
+    assert router.db_for_read() in ('slave1', 'slave2')
+
+
+def test_router_model_route_pool(model, settings):
+    settings.REPLICATED_SLAVE_POOLS = {'analytics': ['slave2']}
+    settings.REPLICATED_MODEL_ROUTES = {'django_replicated': 'analytics'}
+    router = ReplicationRouter()
+    router.use_state('slave')
+
+    for _ in range(10):
+        assert router.db_for_read(model) == 'slave2'
+    assert router.context.chosen['default', 'slave:analytics'] == 'slave2'
+
+
+def test_router_model_route_aliases(model, settings):
+    settings.REPLICATED_MODEL_ROUTES = {'django_replicated': ['slave1']}
+    router = ReplicationRouter()
+    router.use_state('slave')
+
+    assert router.db_for_read(model) == 'slave1'
+
+
+def test_router_model_route_unknown_pool(settings):
+    from django.core.exceptions import ImproperlyConfigured
+
+    settings.REPLICATED_MODEL_ROUTES = {'django_replicated': 'analytics'}
+
+    with pytest.raises(ImproperlyConfigured):
+        ReplicationRouter()
+
+
+@pytest.fixture
+def cluster_router(settings):
+    settings.REPLICATED_DATABASE_SLAVES = ['slave1']
+    settings.REPLICATED_CLUSTERS = {'other': {'master': 'slave2'}}
+    return ReplicationRouter()
+
+
+def test_router_clusters(cluster_router, model):
+    assert cluster_router.all_allowed_aliases == ['default', 'slave1', 'slave2']
+
+    cluster_router.use_state('master', 'other')
+    assert cluster_router.cluster() == 'other'
+    assert cluster_router.db_for_write(model) == 'slave2'
+
+    cluster_router.use_state('slave')
+    assert cluster_router.cluster() == 'other'
+    assert cluster_router.db_for_read(model) == 'slave2'
+
+    cluster_router.revert()
+    cluster_router.revert()
+    assert cluster_router.cluster() == 'default'
+    assert cluster_router.db_for_write(model) == 'default'
+
+
+def test_router_unknown_cluster(cluster_router):
+    with pytest.raises(ValueError):
+        cluster_router.use_state('master', 'unknown')
+
+
+def test_router_model_cluster(model, settings):
+    settings.REPLICATED_CLUSTERS = {'other': {'master': 'slave2', 'models': ['django_replicated']}}
+    router = ReplicationRouter()
+
+    assert router.db_for_write(model) == 'slave2'
+    assert router.db_for_write() == 'default'
+
+
+def test_router_allow_relation_clusters(cluster_router, model):
+    obj1 = model()
+    obj1._state.db = 'slave1'
+    obj2 = model()
+    obj2._state.db = 'slave2'
+
+    assert not cluster_router.allow_relation(obj1, obj2)
+
+    obj2._state.db = 'default'
+    assert cluster_router.allow_relation(obj1, obj2)
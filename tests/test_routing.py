@@ -0,0 +1,113 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import threading
+
+import pytest
+
+from django_replicated import use_master, use_slave, use_state
+from django_replicated.utils import routers
+
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture(autouse=True)
+def _reset(request):
+    routers.reset()
+    request.addfinalizer(routers.reset)
+
+
+def test_context_manager_nesting():
+    assert routers.state() == 'master'
+
+    with use_slave():
+        assert routers.state() == 'slave'
+        with use_master():
+            assert routers.state() == 'master'
+        assert routers.state() == 'slave'
+
+    assert routers.state() == 'master'
+
+
+def test_context_manager_exception():
+    with pytest.raises(ValueError):
+        with use_slave():
+            raise ValueError()
+
+    assert routers.state() == 'master'
+    assert routers.context.state_stack == []
+
+
+def test_decorator():
+    @use_slave
+    def bare():
+        return routers.state()
+
+    @use_slave()
+    def called():
+        return routers.state()
+
+    assert bare() == 'slave'
+    assert called() == 'slave'
+    assert bare.__name__ == 'bare'
+    assert routers.state() == 'master'
+
+
+def test_decorator_reentrant():
+    @use_slave
+    def recurse(depth):
+        with use_master():
+            if depth:
+                recurse(depth - 1)
+        return routers.state()
+
+    assert recurse(3) == 'slave'
+    assert routers.context.state_stack == []
+
+
+def test_cluster():
+    with pytest.raises(ValueError):
+        with use_slave(cluster='unknown'):
+            pass
+
+    with pytest.raises(ValueError):
+        use_state('replica')
+
+    with use_slave(cluster='default'):
+        assert routers.cluster() == 'default'
+
+
+def test_shares_chosen_slave():
+    routers.init('slave')
+    chosen = routers.db_for_read()
+
+    with use_master():
+        with use_slave():
+            assert routers.db_for_read() == chosen
+
+    assert routers.state() == 'slave'
+
+
+def test_exit_after_reset():
+    with use_slave():
+        routers.reset()
+
+    assert routers.state() == 'master'
+
+
+def test_threads():
+    states = {}
+
+    def work():
+        states['thread'] = routers.state()
+        with use_slave():
+            states['thread_inside'] = routers.state()
+
+    with use_master():
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        assert routers.state() == 'master'
+
+    assert states == {'thread': 'master', 'thread_inside': 'slave'}
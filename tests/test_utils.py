@@ -0,0 +1,51 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import pytest
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import router as django_router
+from django.test.utils import override_settings
+
+from django_replicated.router import ReplicationRouter
+from django_replicated.utils import routers
+
+
+class OtherRouter(object):
+    def other_method(self):
+        return 'other'
+
+
+def test_routers_resolved_once():
+    router = routers.router
+
+    assert isinstance(router, ReplicationRouter)
+    assert routers.router is router
+    assert routers.all_allowed_aliases is router.all_allowed_aliases
+
+
+def test_routers_invalidated_on_setting_change():
+    router = routers.router
+
+    with override_settings(DATABASE_ROUTERS=['tests.test_utils.OtherRouter',
+                                             'django_replicated.router.ReplicationRouter']):
+        assert routers.router is not router
+        assert routers.router is django_router.routers[1]
+        assert routers.other_method() == 'other'
+
+    assert routers.router is not router
+
+
+def test_routers_not_installed():
+    with override_settings(DATABASE_ROUTERS=['tests.test_utils.OtherRouter']):
+        with pytest.raises(ImproperlyConfigured):
+            routers.router
+
+        with pytest.raises(ImproperlyConfigured):
+            from django_replicated.middleware import ReplicationMiddleware
+            ReplicationMiddleware()
+
+        assert routers.other_method() == 'other'
+
+        with pytest.raises(AttributeError):
+            routers.state
@@ -0,0 +1,55 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import pytest
+from mock import patch
+
+from django.db import connections
+from django.test.utils import override_settings
+
+from django_replicated import dbchecker
+from django_replicated.prober import Health
+from django_replicated.utils import routers
+from django_replicated.warmup import warmup
+
+
+pytestmark = pytest.mark.django_db
+
+
+def test_warmup():
+    with patch('django_replicated.dbchecker.run_checker', side_effect=lambda checker, alias, tries: alias != 'slave2'):
+        results = warmup(queries=['SELECT 1'])
+
+    assert results == {'default': True, 'slave1': True, 'slave2': False}
+    assert dbchecker.cache.get(dbchecker.get_cache_key('is_alive', 'slave2')) == 'dead'
+    assert connections['slave1'].connection is not None
+
+
+def test_warmup_failed_query():
+    with patch('django_replicated.dbchecker.run_checker', return_value=True):
+        assert warmup(['slave1'], queries=['SELECT * FROM missing_table']) == {'slave1': True}
+
+
+def test_warmup_prober():
+    router = routers.router
+    with patch.object(router, 'prober') as prober:
+        prober.probe_one.side_effect = lambda alias: Health(alias == 'slave1', False, None)
+
+        assert warmup(['slave1', 'slave2']) == {'slave1': True, 'slave2': False}
+
+        assert prober.ensure_running.call_count == 1
+        snapshot = prober.publish.call_args[0][0]
+        assert snapshot['slave1'].alive
+
+
+def test_app_config_ready():
+    from django_replicated.apps import ReplicatedConfig
+
+    config = ReplicatedConfig('django_replicated', __import__('django_replicated'))
+    with patch('django_replicated.warmup.warmup') as warmup_mock:
+        config.ready()
+        assert warmup_mock.call_count == 0
+
+        with override_settings(REPLICATED_WARMUP=True):
+            config.ready()
+        assert warmup_mock.call_count == 1